@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# osm_api_server
+# Minimal local stand-in for the OSM API 0.6, for testing --upload of the population2osm programs without editing OSM.
+# Supports changeset create, upload of osmChange and close, plus reading the current version of an element.
+# Elements in the given OSM file are the current data of the server. Uploads are checked against their versions,
+# and version mismatches are refused with 409 Conflict in the same way as the OSM API.
+# With --conflict, the version of every loaded element is increased by one, to test resolving of version conflicts.
+# Usage: osm_api_server.py [OSM filename] [--port port] [--conflict]
+# Then run for example: population2osm.py --upload --api http://localhost:8000 (with any OSM_ACCESS_TOKEN)
+
+
+import sys
+import argparse
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from xml.etree import ElementTree as ET
+
+
+elements = {}  # Current elements of server, (type, id) -> element
+
+changesets = {}  # Changeset id -> open (True) or closed (False)
+
+next_id = {
+	'changeset': 1,
+	'element': 1000000000  # New elements get ids above this
+}
+
+
+
+# Output message
+
+def message (line):
+
+	sys.stdout.write (line)
+	sys.stdout.flush()
+
+
+
+# Handler of OSM API requests
+
+class OsmApiHandler (BaseHTTPRequestHandler):
+
+	# Send response with given status and text
+
+	def respond (self, status, text, content_type="text/plain"):
+
+		data = text.encode("utf-8")
+		self.send_response(status)
+		self.send_header("Content-Type", "%s; charset=utf-8" % content_type)
+		self.send_header("Content-Length", str(len(data)))
+		self.end_headers()
+		self.wfile.write(data)
+
+
+	# Read request body
+
+	def read_body (self):
+
+		length = int(self.headers.get("Content-Length", 0))
+		return self.rfile.read(length)
+
+
+	# Get path parts after /api/0.6/
+
+	def api_path (self):
+
+		if not self.path.startswith("/api/0.6/"):
+			return None
+		return self.path[ len("/api/0.6/") : ].split("?")[0].split("/")
+
+
+	# Current version of element
+
+	def do_GET (self):
+
+		path = self.api_path()
+		if path is None or len(path) != 2 or (path[0], path[1]) not in elements:
+			self.respond(404, "Not found")
+			return
+
+		osm = ET.Element("osm", version="0.6", generator="osm_api_server")
+		osm.append(elements[ (path[0], path[1]) ])
+		self.respond(200, ET.tostring(osm, encoding="unicode"), "text/xml")
+
+
+	# Changeset create and close
+
+	def do_PUT (self):
+
+		path = self.api_path()
+		body = self.read_body()
+
+		if path == ["changeset", "create"]:
+			changeset_id = str(next_id['changeset'])
+			next_id['changeset'] += 1
+			changesets[ changeset_id ] = True
+			tags = ", ".join("%s=%s" % (tag.attrib['k'], tag.attrib['v']) for tag in ET.fromstring(body).iter("tag"))
+			message ("Changeset %s created: %s\n" % (changeset_id, tags))
+			self.respond(200, changeset_id)
+
+		elif path is not None and len(path) == 3 and path[0] == "changeset" and path[2] == "close":
+			if path[1] not in changesets:
+				self.respond(404, "Changeset %s not found" % path[1])
+			elif not changesets[ path[1] ]:
+				self.respond(409, "The changeset %s was closed" % path[1])
+			else:
+				changesets[ path[1] ] = False
+				message ("Changeset %s closed\n" % path[1])
+				self.respond(200, "")
+
+		else:
+			self.respond(404, "Not found")
+
+
+	# Upload of osmChange to changeset
+	# The upload is checked before any element is changed, like the OSM API applies the whole diff or nothing
+
+	def do_POST (self):
+
+		path = self.api_path()
+		body = self.read_body()
+
+		if path is None or len(path) != 3 or path[0] != "changeset" or path[2] != "upload":
+			self.respond(404, "Not found")
+			return
+
+		changeset_id = path[1]
+		if not changesets.get(changeset_id):
+			self.respond(409, "The changeset %s was closed" % changeset_id)
+			return
+
+		change = ET.fromstring(body)
+
+		for element in change.iterfind("modify/*"):
+			current = elements.get((element.tag, element.attrib['id']))
+			if current is None:
+				self.respond(404, "The %s with the id %s was not found" % (element.tag, element.attrib['id']))
+				return
+			if element.attrib.get("version") != current.attrib['version']:
+				self.respond(409, "Version mismatch: Provided %s, server had: %s of %s %s"
+								% (element.attrib.get("version"), current.attrib['version'], element.tag.capitalize(), element.attrib['id']))
+				return
+
+		diff = ET.Element("diffResult", version="0.6", generator="osm_api_server")
+
+		for element in change.iterfind("create/*"):
+			new_id = str(next_id['element'])
+			next_id['element'] += 1
+			ET.SubElement(diff, element.tag, old_id=element.attrib['id'], new_id=new_id, new_version="1")
+			element.set("id", new_id)
+			element.set("version", "1")
+			elements[ (element.tag, new_id) ] = element
+
+		for element in change.iterfind("modify/*"):
+			new_version = str(int(element.attrib['version']) + 1)
+			ET.SubElement(diff, element.tag, old_id=element.attrib['id'], new_id=element.attrib['id'], new_version=new_version)
+			element.set("version", new_version)
+			elements[ (element.tag, element.attrib['id']) ] = element
+
+		message ("Changeset %s: %i elements uploaded\n" % (changeset_id, len(diff)))
+		self.respond(200, ET.tostring(diff, encoding="unicode"), "text/xml")
+
+
+	# Log requests on one line
+
+	def log_message (self, format, *args):
+
+		message ("\t%s\n" % (format % args))
+
+
+
+# Main program
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description="Local stand-in for the OSM API 0.6 for testing uploads")
+	parser.add_argument("filename", nargs="?", help="OSM file with current elements of the server")
+	parser.add_argument("--port", type=int, default=8000, help="port of server (default 8000)")
+	parser.add_argument("--conflict", action="store_true", help="increase version of loaded elements to cause version conflicts")
+	args = parser.parse_args()
+
+	if args.filename:
+		for element in ET.parse(args.filename).getroot():
+			if element.tag in ["node", "way", "relation"] and int(element.attrib['id']) > 0:
+				element.attrib.pop("action", None)
+				if args.conflict:
+					element.set("version", str(int(element.attrib['version']) + 1))
+				elements[ (element.tag, element.attrib['id']) ] = element
+
+	message ("OSM API stand-in with %i elements at http://localhost:%i, press Ctrl-C to stop\n" % (len(elements), args.port))
+
+	server = HTTPServer(("localhost", args.port), OsmApiHandler)
+	try:
+		server.serve_forever()
+	except KeyboardInterrupt:
+		message ("\nStopped\n")
@@ -0,0 +1,743 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# osm_tools
+# Shared functions for loading and saving data used by the population2osm programs.
+# Overpass data is parsed with one of these backends:
+#   json - Overpass [out:json] output (default)
+#   lxml - XML parsed by lxml, if installed, and converted to standard library elements
+#   xml  - XML parsed by the Python standard library (fallback)
+# The backend is selected with the --parser option of the programs. Use parser_benchmark.py to compare the backends.
+# All backends produce the same ElementTree model, and output files are identical whichever backend is used.
+# Loaded data may be kept in a local SQLite snapshot store, which is refreshed incrementally and
+# may be used instead of Overpass when the network is slow or down.
+# When only a few elements change, the tags may be compared first and full data loaded only for modified elements.
+# Modified elements may be uploaded directly to the OSM API.
+# Each phase of the programs may be profiled with cProfile and tracemalloc.
+
+
+import sys
+import re
+import copy
+import contextlib
+import json
+import time
+import sqlite3
+import cProfile
+import tracemalloc
+import urllib.error
+import urllib.parse
+import urllib.request
+from io import BytesIO
+from xml.etree import ElementTree as ET
+
+try:
+	from lxml import etree as lxml_etree
+except ImportError:
+	lxml_etree = None
+
+try:
+	import orjson
+except ImportError:
+	orjson = None
+
+
+overpass_url = "https://overpass-api.de/api/interpreter?data="
+
+parser_backends = ['json', 'lxml', 'xml']
+
+store_filename = "population2osm.sqlite"  # Default snapshot store
+
+api_url = "https://api.openstreetmap.org"  # OSM API for upload
+
+max_conflicts = 10  # Max number of version conflicts resolved per upload batch
+
+profile_name = None  # File name prefix for profiles, if profiling is enabled
+
+profiles = {}  # Profile data accumulated for each phase
+
+current_phase = None  # Phase being profiled
+
+# Tags updated by the programs, reapplied to the current version of an element after an upload conflict
+
+population_keys = ['population', 'population:date', 'source:population', 'ref:ssb_tettsted']
+
+element_types = ['node', 'way', 'relation', 'area']  # OSM elements in Overpass output
+
+# Attribute order of Overpass XML output, used when building elements from JSON
+
+element_attributes = {
+	'node': ['id', 'lat', 'lon', 'version', 'timestamp', 'changeset', 'uid', 'user'],
+	'way': ['id', 'version', 'timestamp', 'changeset', 'uid', 'user'],
+	'relation': ['id', 'version', 'timestamp', 'changeset', 'uid', 'user'],
+	'area': ['id']
+}
+
+
+
+# Output message
+
+def message (line):
+
+	sys.stdout.write (line)
+	sys.stdout.flush()
+
+
+
+# Load JSON from url, using orjson if installed
+
+def load_json (url, request_header):
+
+	request = urllib.request.Request(url, headers=request_header)
+	file = urllib.request.urlopen(request)
+	if orjson is not None:
+		data = orjson.loads(file.read())
+	else:
+		data = json.load(file)
+	file.close()
+
+	return data
+
+
+
+# Parse Overpass XML with the standard library
+# Whitespace between elements is removed to get the same tree as the other backends
+
+def parse_xml (file):
+
+	tree = ET.parse(file)
+
+	for element in tree.iter():
+		if element.text is not None and not element.text.strip():
+			element.text = None
+		element.tail = None
+
+	return tree
+
+
+
+# Parse Overpass XML with lxml and convert to standard library elements
+
+def parse_lxml (file):
+
+	parser = lxml_etree.XMLParser(remove_blank_text=True, huge_tree=True)
+	lxml_root = lxml_etree.parse(file, parser).getroot()
+
+	root = ET.Element(lxml_root.tag, dict(lxml_root.attrib))
+	stack = [(lxml_root, root)]
+
+	while stack:
+		lxml_parent, parent = stack.pop()
+		for lxml_element in lxml_parent:
+			element = ET.SubElement(parent, lxml_element.tag, dict(lxml_element.attrib))
+			if lxml_element.text is not None and lxml_element.text.strip():
+				element.text = lxml_element.text
+			if len(lxml_element):
+				stack.append((lxml_element, element))
+
+	return ET.ElementTree(root)
+
+
+
+# Parse Overpass JSON and build the same elements as Overpass XML output
+# Numbers are kept as text to get identical coordinates
+
+def parse_json (file):
+
+	data = json.load(file, parse_float=str, parse_int=str)
+
+	root = ET.Element("osm", version=data['version'], generator=data['generator'])
+
+	if "osm3s" in data:
+		note = ET.SubElement(root, "note")
+		note.text = data['osm3s']['copyright']
+		meta = ET.SubElement(root, "meta", osm_base=data['osm3s']['timestamp_osm_base'])
+		if "timestamp_areas_base" in data['osm3s']:
+			meta.set("areas", data['osm3s']['timestamp_areas_base'])
+
+	for entry in data['elements']:
+		element = ET.SubElement(root, entry['type'])
+		for key in element_attributes.get(entry['type'], ['id']):
+			if key in entry:
+				element.set(key, entry[key])
+
+		if "nodes" in entry:
+			for node_ref in entry['nodes']:
+				ET.SubElement(element, "nd", ref=node_ref)
+
+		if "members" in entry:
+			for member in entry['members']:
+				ET.SubElement(element, "member", type=member['type'], ref=member['ref'], role=member['role'])
+
+		if "tags" in entry:
+			for key, value in iter(entry['tags'].items()):
+				ET.SubElement(element, "tag", k=key, v=value)
+
+	return ET.ElementTree(root)
+
+
+
+# Fetch raw Overpass output for query
+
+def fetch_overpass (query, request_header):
+
+	request = urllib.request.Request(overpass_url + urllib.parse.quote(query), headers=request_header)
+	file = urllib.request.urlopen(request)
+	data = file.read()
+	file.close()
+
+	return data
+
+
+
+# Parse raw Overpass output with given backend
+# Returns ElementTree
+
+def parse_osm (data, backend):
+
+	if backend == "lxml":
+		return parse_lxml(BytesIO(data))
+	elif backend == "json":
+		return parse_json(BytesIO(data))
+	else:
+		return parse_xml(BytesIO(data))
+
+
+
+# Run Overpass query and parse output
+# The standard library XML parser is used if the selected backend fails
+
+def query_overpass (query, request_header, backend):
+
+	if backend == "json":
+		data = fetch_overpass(query.replace("[out:xml]", "[out:json]", 1), request_header)
+	else:
+		data = fetch_overpass(query, request_header)
+
+	try:
+		return parse_osm(data, backend)
+	except (ValueError, KeyError, SyntaxError):
+		if backend == "json":
+			data = fetch_overpass(query, request_header)
+		return parse_osm(data, "xml")
+
+
+
+# Open snapshot store, creating tables and ref indexes if needed
+# Returns SQLite connection
+
+def open_store (filename=store_filename):
+
+	store = sqlite3.connect(filename)
+	store.executescript('''
+		CREATE TABLE IF NOT EXISTS elements (type TEXT, id INTEGER, version INTEGER, data TEXT, PRIMARY KEY (type, id));
+		CREATE TABLE IF NOT EXISTS snapshots (query TEXT PRIMARY KEY, osm_base TEXT, header TEXT);
+		CREATE TABLE IF NOT EXISTS members (query TEXT, position INTEGER, type TEXT, id INTEGER, PRIMARY KEY (query, position));
+	''')
+
+	return store
+
+
+
+# Save elements to store, replacing older versions
+
+def store_elements (store, elements):
+
+	rows = []
+	for element in elements:
+		rows.append((element.tag, int(element.attrib['id']), int(element.attrib.get('version', 0)), ET.tostring(element, encoding="unicode")))
+
+	store.executemany("INSERT OR REPLACE INTO elements (type, id, version, data) VALUES (?, ?, ?, ?)", rows)
+
+
+
+# Save snapshot of query result to store
+# The root element with note and meta is kept as header, the elements are saved separately as members.
+# If members is None, the elements are kept in the header instead, for elements without version from
+# queries which do not end with out meta; and which would otherwise replace the full elements.
+
+def store_snapshot (store, query, root, members):
+
+	header = ET.Element(root.tag, root.attrib)
+	for element in root:
+		if element.tag not in element_types or members is None:
+			header.append(element)
+	header.append(ET.Element("elements"))
+
+	if members is None:
+		members = []
+
+	meta = root.find("meta")
+	osm_base = meta.attrib['osm_base'] if meta is not None else None
+
+	store.execute("INSERT OR REPLACE INTO snapshots VALUES (?, ?, ?)", (query, osm_base, ET.tostring(header, encoding="unicode")))
+	store.execute("DELETE FROM members WHERE query = ?", (query,))
+	store.executemany("INSERT INTO members VALUES (?, ?, ?, ?)",
+						[(query, position, element_type, element_id) for position, (element_type, element_id) in enumerate(members)])
+	store.commit()
+
+
+
+# Build tree for query from store, with elements in the same order as the Overpass output
+# Returns ElementTree, or None if query is not in store
+
+def load_snapshot (store, query):
+
+	snapshot = store.execute("SELECT header FROM snapshots WHERE query = ?", (query,)).fetchone()
+	if snapshot is None:
+		return None
+
+	rows = store.execute("SELECT elements.data FROM members JOIN elements USING (type, id) WHERE members.query = ? ORDER BY members.position", (query,))
+	header_start, header_end = snapshot[0].split("<elements />")
+	data = header_start + "".join(row[0] for row in rows) + header_end
+
+	return parse_xml(BytesIO(data.encode("utf-8")))
+
+
+
+# Refresh snapshot of query in store
+# Only ids and the elements changed since the previous snapshot are loaded from Overpass,
+# plus any new member elements which are not already in the store
+
+def refresh_snapshot (store, query, request_header, backend):
+
+	settings, selection = query.split(";", 1)
+	selection = selection[ : selection.rindex("out meta;") ]
+	osm_base = store.execute("SELECT osm_base FROM snapshots WHERE query = ?", (query,)).fetchone()[0]
+
+	newer = '(newer:"%s")' % osm_base
+	root = query_overpass(settings + ";" + selection + "out ids;(node._%s;way._%s;relation._%s;);out meta;" % (newer, newer, newer),
+							request_header, backend).getroot()
+
+	members = []
+	changed = []
+	for element in root:
+		if element.tag in element_types:
+			if "version" in element.attrib:
+				changed.append(element)
+			else:
+				members.append((element.tag, int(element.attrib['id'])))
+
+	store_elements(store, changed)
+
+	missing = {}
+	for element_type, element_id in members:
+		if store.execute("SELECT 1 FROM elements WHERE type = ? AND id = ?", (element_type, element_id)).fetchone() is None:
+			if element_type not in missing:
+				missing[ element_type ] = []
+			missing[ element_type ].append(str(element_id))
+
+	if missing:
+		missing_query = "".join("%s(id:%s);" % (element_type, ",".join(ids)) for element_type, ids in iter(missing.items()))
+		missing_root = query_overpass(settings + ";(" + missing_query + ");out meta;", request_header, backend).getroot()
+		store_elements(store, [element for element in missing_root if element.tag in element_types])
+
+	store_snapshot(store, query, root, members)
+
+
+
+# Load OSM data from Overpass
+# Parameter query is an Overpass query starting with [out:xml]
+# If a snapshot store is given, the query result is refreshed in the store and loaded from it.
+# Only queries ending with out meta; are refreshed incrementally, other queries are reloaded and kept whole in the snapshot.
+# The stored snapshot is used if Overpass cannot be reached, or always if offline is True.
+# Returns ElementTree
+
+def load_overpass (query, request_header, backend="json", store=None, offline=False):
+
+	if store is None:
+		return query_overpass(query, request_header, backend)
+
+	if not offline:
+		try:
+			if not query.endswith("out meta;"):
+				tree = query_overpass(query, request_header, backend)
+				store_snapshot(store, query, tree.getroot(), None)
+			elif store.execute("SELECT 1 FROM snapshots WHERE query = ?", (query,)).fetchone() is None:
+				tree = query_overpass(query, request_header, backend)
+				elements = [element for element in tree.getroot() if element.tag in element_types]
+				store_elements(store, elements)
+				store_snapshot(store, query, tree.getroot(), [(element.tag, int(element.attrib['id'])) for element in elements])
+			else:
+				refresh_snapshot(store, query, request_header, backend)
+
+		except (urllib.error.URLError, OSError) as error:
+			message ("\n\t*** Overpass not available, using snapshot store (%s)\n" % error)
+
+	tree = load_snapshot(store, query)
+	if tree is None:
+		raise ValueError("Query not found in snapshot store: %s" % query)
+
+	return tree
+
+
+
+# Load full data for the modified elements of a tree loaded with out tags; instead of out meta;
+# Only the modified elements are loaded from Overpass, in one out meta; query by id,
+# and their population tags are applied to the loaded elements.
+# Unmodified elements are left out, as elements without version cannot be saved or uploaded.
+# Returns ElementTree with the modified elements in the same order as the given tree
+
+def load_modified (tree, request_header, backend="json"):
+
+	root = tree.getroot()
+	modified = [element for element in root if element.tag in element_types and element.get("action") == "modify"]
+
+	ids = {}
+	for element in modified:
+		ids.setdefault(element.tag, []).append(element.attrib['id'])
+
+	query = "[out:xml][timeout:90];("
+	for element_type in ["node", "way", "relation"]:
+		if element_type in ids:
+			query += "%s(id:%s);" % (element_type, ",".join(ids[ element_type ]))
+	query += ");out meta;"
+
+	if ids:
+		full_root = query_overpass(query, request_header, backend).getroot()
+	else:
+		full_root = ET.Element("osm")
+
+	full_elements = {}
+	for element in full_root:
+		full_elements[ (element.tag, element.get("id")) ] = element
+
+	new_root = ET.Element(root.tag, root.attrib)
+	for element in full_root:
+		if element.tag not in element_types:
+			new_root.append(element)
+
+	for element in modified:
+		full_element = full_elements.get((element.tag, element.attrib['id']))
+		if full_element is not None:
+			apply_population_tags(element, full_element)
+			new_root.append(full_element)
+		else:
+			message ("\t*** %s %s not found in Overpass\n" % (element.tag, element.attrib['id']))
+
+	return ET.ElementTree(new_root)
+
+
+
+# Save OSM file with indented XML, ready for JOSM
+
+def save_osm (tree, filename, generator):
+
+	root = tree.getroot()
+	root.set("generator", generator)
+	root.set("upload", "false")
+
+	ET.indent(tree, space="  ")
+	tree.write(filename, encoding="utf-8", method="xml", xml_declaration=True)
+
+
+
+# Split modified and new elements into several OSM files of at most max_elements each, for separate uploads
+# Elements are grouped by group_function (e.g. county), and a group is only split if it is larger than max_elements
+# Unmodified nodes, ways and relation members referenced by the elements are included without action
+# Returns list of file names, which are <filename>_<n>.osm
+
+def split_osm (tree, filename, generator, max_elements, group_function):
+
+	root = tree.getroot()
+
+	elements = {}
+	groups = {}
+	for element in root:
+		if element.tag in element_types:
+			elements[ (element.tag, element.attrib['id']) ] = element
+			if element.get("action") == "modify":
+				group = group_function(element)
+				if group not in groups:
+					groups[ group ] = []
+				groups[ group ].append(element)
+
+	# Pack whole groups into chunks
+
+	chunks = []
+	chunk = []
+	for group in sorted(groups):
+		group_elements = groups[ group ]
+		if chunk and len(chunk) + len(group_elements) > max_elements:
+			chunks.append(chunk)
+			chunk = []
+		while len(group_elements) > max_elements:
+			chunks.append(group_elements[ : max_elements ])
+			group_elements = group_elements[ max_elements : ]
+		chunk.extend(group_elements)
+	if chunk:
+		chunks.append(chunk)
+
+	# Produce one file per chunk, with elements in the original order
+
+	if filename.endswith(".osm"):
+		filename = filename[:-4]
+
+	filenames = []
+	for number, chunk in enumerate(chunks, 1):
+		included = set(id(element) for element in chunk)
+		context = set()
+		stack = list(chunk)
+		while stack:
+			element = stack.pop()
+			for reference in element:
+				if reference.tag == "nd":
+					key = ("node", reference.attrib['ref'])
+				elif reference.tag == "member":
+					key = (reference.attrib['type'], reference.attrib['ref'])
+				else:
+					continue
+				if key in elements and id(elements[ key ]) not in included and id(elements[ key ]) not in context:
+					context.add(id(elements[ key ]))
+					stack.append(elements[ key ])
+
+		chunk_root = ET.Element(root.tag, root.attrib)
+		for element in root:
+			if element.tag not in element_types or id(element) in included:
+				chunk_root.append(element)
+			elif id(element) in context:
+				context_element = copy.deepcopy(element)
+				context_element.attrib.pop("action", None)
+				chunk_root.append(context_element)
+
+		chunk_filename = "%s_%i.osm" % (filename, number)
+		save_osm(ET.ElementTree(chunk_root), chunk_filename, generator)
+		filenames.append(chunk_filename)
+
+	return filenames
+
+
+
+# Send request to OSM API, authorized with OAuth 2 access token
+# Returns response
+
+def api_request (api, token, request_header, method, path, data=None):
+
+	headers = dict(request_header)
+	headers['Authorization'] = "Bearer %s" % token
+	if data is not None:
+		headers['Content-Type'] = "text/xml; charset=utf-8"
+
+	request = urllib.request.Request(api + "/api/0.6/" + path, data=data, headers=headers, method=method)
+	file = urllib.request.urlopen(request)
+	response = file.read()
+	file.close()
+
+	return response
+
+
+
+# Copy element for osmChange upload in given changeset
+
+def change_element (element, changeset_id):
+
+	change = ET.Element(element.tag, id=element.attrib['id'], changeset=changeset_id)
+	if "version" in element.attrib:
+		change.set("version", element.attrib['version'])
+	if element.tag == "node":
+		change.set("lat", element.attrib['lat'])
+		change.set("lon", element.attrib['lon'])
+
+	for child in element:
+		if child.tag in ["nd", "member", "tag"]:
+			change.append(ET.Element(child.tag, child.attrib))
+
+	return change
+
+
+
+# Copy population tags of element to another version of the same element and mark it as modified
+
+def apply_population_tags (element, current):
+
+	for key in population_keys:
+		tag = element.find("tag[@k='%s']" % key)
+		if tag is not None:
+			current_tag = current.find("tag[@k='%s']" % key)
+			if current_tag is not None:
+				current_tag.set("v", tag.attrib['v'])
+			else:
+				current.append(ET.Element("tag", k=key, v=tag.attrib['v']))
+
+	current.set("action", "modify")
+
+
+
+# Load current version of element from OSM API and reapply population tags of given element
+# Returns updated current element
+
+def refresh_element (element, api, token, request_header):
+
+	response = api_request(api, token, request_header, "GET", "%s/%s" % (element.tag, element.attrib['id']))
+	current = ET.fromstring(response).find(element.tag)
+
+	apply_population_tags(element, current)
+	return current
+
+
+
+# Upload modified and new elements to OSM API in one changeset, with diff uploads of at most batch_size elements
+# Elements with working tags in upper case (e.g. MUNICIPALITY, NOT_FOUND) must be checked manually and are not uploaded
+# Version conflicts are resolved by reapplying the population tags to the current version of the element
+# Returns changeset id, number of uploaded elements and number of skipped elements
+
+def upload_osm (tree, api, token, request_header, changeset_tags, batch_size):
+
+	elements = []
+	skipped = 0
+	for element in tree.getroot():
+		if element.tag in ['node', 'way', 'relation'] and element.get("action") == "modify":
+			if any(tag.attrib['k'].isupper() for tag in element.iter("tag")):
+				skipped += 1
+			else:
+				elements.append(element)
+
+	if not elements:
+		return None, 0, skipped
+
+	# Open changeset
+
+	changeset = ET.Element("changeset")
+	for key, value in iter(changeset_tags.items()):
+		changeset.append(ET.Element("tag", k=key, v=value))
+	osm = ET.Element("osm")
+	osm.append(changeset)
+
+	changeset_id = api_request(api, token, request_header, "PUT", "changeset/create", ET.tostring(osm, encoding="utf-8")).decode().strip()
+
+	# Upload batches
+
+	try:
+		for start in range(0, len(elements), batch_size):
+			batch = elements[ start : start + batch_size ]
+
+			for conflict in range(max_conflicts + 1):
+				change = ET.Element("osmChange", version="0.6", generator=changeset_tags.get("created_by", ""))
+				created = [ element for element in batch if int(element.attrib['id']) < 0 ]
+				modified = [ element for element in batch if int(element.attrib['id']) > 0 ]
+				for action, action_elements in [("create", created), ("modify", modified)]:
+					if action_elements:
+						action_element = ET.SubElement(change, action)
+						for element in action_elements:
+							action_element.append(change_element(element, changeset_id))
+
+				try:
+					api_request(api, token, request_header, "POST", "changeset/%s/upload" % changeset_id, ET.tostring(change, encoding="utf-8"))
+					break
+
+				except urllib.error.HTTPError as error:
+					# Example: "Version mismatch: Provided 3, server had: 4 of Relation 1234"
+					match = re.search(r"of (Node|Way|Relation) (\d+)", error.read().decode("utf-8", "replace"))
+					if error.code != 409 or match is None or conflict == max_conflicts:
+						raise
+					for index, element in enumerate(batch):
+						if element.tag == match.group(1).lower() and element.attrib['id'] == match.group(2):
+							batch[ index ] = refresh_element(element, api, token, request_header)
+							message ("\tVersion conflict for %s %s resolved\n" % (element.tag, element.attrib['id']))
+							break
+					else:
+						raise
+
+			message ("\tUploaded %i of %i elements\n" % (min(start + batch_size, len(elements)), len(elements)))
+
+	finally:
+		# Errors when closing are only logged, to not hide any upload error. The API closes the changeset after one hour.
+		try:
+			api_request(api, token, request_header, "PUT", "changeset/%s/close" % changeset_id)
+		except (urllib.error.URLError, OSError) as error:
+			message ("\t*** Could not close changeset %s: %s\n" % (changeset_id, error))
+
+	return changeset_id, len(elements), skipped
+
+
+
+# Enable profiling of phases, with given prefix for profile file names
+
+def enable_profile (name):
+
+	global profile_name
+	profile_name = name
+
+
+
+# Start profiling of phase, if profiling is enabled
+# A phase may be started and stopped several times, and the profile is accumulated
+
+def start_profile (phase):
+
+	global current_phase
+
+	if profile_name is None:
+		return
+
+	if phase not in profiles:
+		profiles[ phase ] = {
+			'profiler': cProfile.Profile(),
+			'memory': {},
+			'peak': 0,
+			'time': 0.0
+		}
+
+	profile = profiles[ phase ]
+	tracemalloc.start()
+	profile['snapshot'] = tracemalloc.take_snapshot()
+	profile['start'] = time.time()
+	current_phase = phase
+	profile['profiler'].enable()
+
+
+
+# Stop profiling of current phase and save profile
+# Saves <name>_<phase>.pstats for cProfile and <name>_<phase>_memory.txt with peak memory and top allocations
+
+def stop_profile():
+
+	global current_phase
+
+	if current_phase is None:
+		return
+
+	phase = current_phase
+	current_phase = None
+
+	profile = profiles[ phase ]
+	profile['profiler'].disable()
+	profile['time'] += time.time() - profile['start']
+
+	exclude = [ tracemalloc.Filter(False, tracemalloc.__file__) ]
+	snapshot = tracemalloc.take_snapshot().filter_traces(exclude)
+	profile['peak'] = max(profile['peak'], tracemalloc.get_traced_memory()[1])
+	tracemalloc.stop()
+
+	for stat in snapshot.compare_to(profile['snapshot'].filter_traces(exclude), "lineno"):
+		location = str(stat.traceback)
+		profile['memory'][ location ] = profile['memory'].get(location, 0) + stat.size_diff
+	del profile['snapshot']
+
+	filename = "%s_%s" % (profile_name, phase)
+	profile['profiler'].dump_stats(filename + ".pstats")
+
+	file = open(filename + "_memory.txt", "w")
+	file.write("Phase: %s\n" % phase)
+	file.write("Time: %.2f s\n" % profile['time'])
+	file.write("Peak memory: %.1f MB\n\n" % (profile['peak'] / 1000000.0))
+	file.write("Top allocations retained (size, location):\n")
+	for location, size in sorted(profile['memory'].items(), key=lambda item: -item[1])[:25]:
+		file.write("%10.1f kB  %s\n" % (size / 1000.0, location))
+	file.close()
+
+	message ("\t[Profile %s: %.2f s, peak memory %.1f MB]\n" % (phase, profile['time'], profile['peak'] / 1000000.0))
+
+
+
+# Profile phase of program in with statement, if profiling is enabled
+# The profile is stopped and saved also if the phase fails with an exception
+
+@contextlib.contextmanager
+def profile_phase (phase):
+
+	start_profile(phase)
+	try:
+		yield
+	finally:
+		stop_profile()
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+# -*- coding: utf8
+
+# parser_benchmark
+# Compares the Overpass parser backends in osm_tools on the Norwegian municipality relations.
+# Downloads the data once per format, times parsing for each available backend and
+# checks that the saved OSM files are identical.
+# Usage: parser_benchmark.py [repetitions]
+
+
+import sys
+import time
+import os
+import tempfile
+from osm_tools import fetch_overpass, parse_osm, save_osm, parser_backends, lxml_etree
+
+
+request_header = { "User-Agent": "osm-no/population2osm" }
+
+query = '[out:xml][timeout:90];(area["name"="Norge"]["type"="boundary"];)->.a;(relation["place"="municipality"](area.a););out meta;'
+
+
+
+# Output message
+
+def message (line):
+
+	sys.stdout.write (line)
+	sys.stdout.flush()
+
+
+
+# Main program
+
+if __name__ == '__main__':
+
+	if len(sys.argv) > 1:
+		repetitions = int(sys.argv[1])
+	else:
+		repetitions = 5
+
+	message ("\nLoading municipalities from Overpass ... ")
+
+	data = {
+		'xml': fetch_overpass(query, request_header),
+		'json': fetch_overpass(query.replace("[out:xml]", "[out:json]", 1), request_header)
+	}
+	data['lxml'] = data['xml']
+
+	message ("%i kB XML, %i kB JSON\n\n" % (len(data['xml']) / 1024, len(data['json']) / 1024))
+
+	outputs = {}
+	timings = {}
+
+	for backend in parser_backends:
+		if backend == "lxml" and lxml_etree is None:
+			message ("\t%-5s not installed\n" % backend)
+			continue
+
+		start_time = time.time()
+		for i in range(repetitions):
+			tree = parse_osm(data[ backend ], backend)
+		timings[ backend ] = (time.time() - start_time) / repetitions
+
+		filename = os.path.join(tempfile.gettempdir(), "parser_benchmark_%s.osm" % backend)
+		save_osm(tree, filename, "parser_benchmark")
+		file = open(filename, "rb")
+		outputs[ backend ] = file.read()
+		file.close()
+		os.remove(filename)
+
+		message ("\t%-5s %7.3f s\n" % (backend, timings[ backend ]))
+
+	# Speedup relative to the standard library parser
+
+	message ("\nSpeedup relative to standard library XML parser:\n")
+	for backend, timing in iter(timings.items()):
+		message ("\t%-5s %.2fx\n" % (backend, timings['xml'] / timing))
+
+	message ("\nFastest backend: %s (default is json)\n" % min(timings, key=timings.get))
+
+	if len(set(outputs.values())) == 1:
+		message ("\nOutput identical for all backends\n\n")
+	else:
+		message ("\n*** Output differs between backends\n\n")
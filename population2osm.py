@@ -3,20 +3,45 @@
 
 # population2osm
 # Extracts most recent quarterly population numbers from SSB and produces OSM file for import/update of Norwegian municipalities, counties and country
-# Usage: population2osm (no parameters)
+# Usage: population2osm [--watch [minutes]] [--store [filename]] [--offline] [--split [elements]] [--upload [elements]] [--api url] [--profile] [--parser json|lxml|xml] [--tags-first]
 
 
 import sys
+import os
 import json
-import urllib.parse
-import urllib.request
+import time
+import argparse
 from xml.etree import ElementTree as ET
+from osm_tools import load_json, load_overpass, save_osm, open_store, store_filename, split_osm, upload_osm, api_url, load_modified
+from osm_tools import enable_profile, profile_phase, parser_backends, lxml_etree
 
 
 version = "0.4.0"
 
 request_header = { "User-Agent": "osm-no/population2osm" }
 
+ssb_url = "http://data.ssb.no/api/v0/dataset/%s.json?lang=no"
+
+ssb_datasets = ['1104', '1102', '1108']  # Country, counties, municipalities
+
+ssb_list_url = "http://data.ssb.no/api/v0/dataset/list.json?lang=no"  # Updated time of all datasets, polled in watch mode
+
+notification_filename = "Update_population.json"  # Written by watch mode after each update
+
+store = None  # Snapshot store of OSM relations, if used
+
+offline = False  # Use OSM relations from snapshot store only
+
+backend = "json"  # Parser of OSM data from Overpass
+
+split = None  # Max number of modified relations per output file, if output is split
+
+upload = None  # Max number of relations per diff upload to OSM API, if uploading
+
+api = api_url  # OSM API for upload
+
+tags_first = False  # Load tags of relations first, and full data only for modified relations
+
 quarter_dates = {
 	'1': '-04-01',
 	'2': '-07-01',
@@ -37,16 +62,15 @@ def message (line):
 
 # Load SSB data for administrative entities (municipality, county or country)
 # Parameter api_ref is the predefined SSB query at https://data.ssb.no/api/v0/dataset/
+# Optional parameter ssb_data is already loaded data from the SSB api
 # Returns dict with entity name and population + record date of population numbers
 
-def load_ssb (api_ref):
+def load_ssb (api_ref, ssb_data=None):
 
 	# Load predefined data from SSB api
 
-	request = urllib.request.Request("http://data.ssb.no/api/v0/dataset/%s.json?lang=no" % api_ref, headers=request_header)
-	file = urllib.request.urlopen(request)
-	ssb_data = json.load(file)
-	file.close()
+	if ssb_data is None:
+		ssb_data = load_json(ssb_url % api_ref, request_header)
 
 	# Determine index in list of population values from SSB
 
@@ -78,30 +102,59 @@ def load_ssb (api_ref):
 
 
 
-# Main program
+# Get county ref of county or municipality relation, used to keep counties together when splitting output
 
-if __name__ == '__main__':
+def county_ref (relation):
 
-	message ("\nQuarterly update population of Norwegian municipalities, counties and country\n\n")
+	ref_tag = relation.find("tag[@k='ref']")
+	if ref_tag != None and ref_tag.attrib['v'].isdigit():
+		return ref_tag.attrib['v'][:2]
+	return ""
+
+
+
+# Get version of SSB dataset as last updated time and quarter, used to detect new publications and corrections
+
+def ssb_version (ssb_data):
+
+	quarter = list(ssb_data['dataset']['dimension']['Tid']['category']['index'])[0]
+	return "%s %s" % (ssb_data['dataset'].get('updated', ""), quarter)
+
+
+
+# Update population of country, counties and municipalities and save OSM file
+# Parameter ssb_data is dict of already loaded SSB datasets, if any
+# Returns number of updated population tags and population date(s)
+
+def update_population (ssb_data, filename):
 
 	# Load all SSB population data
 
-	country, country_date = load_ssb('1104')
-	message ("Norway population: %s\n" % country['0']['population'])
+	with profile_phase("load_ssb"):
+		country, country_date = load_ssb('1104', ssb_data.get('1104'))
+		message ("Norway population: %s\n" % country['0']['population'])
 
-	counties, county_date = load_ssb('1102')
-	message ("%i counties\n" % len(counties))
-	del counties['03']  # Oslo updated as municipality
-	if "21" in counties:
-		del counties['21']  # Svalbard not updated
+		counties, county_date = load_ssb('1102', ssb_data.get('1102'))
+		message ("%i counties\n" % len(counties))
+		del counties['03']  # Oslo updated as municipality
+		if "21" in counties:
+			del counties['21']  # Svalbard not updated
 
-	municipalities, municipality_date = load_ssb('1108')
-	message ("%i municipalites\n" % len(municipalities))
+		municipalities, municipality_date = load_ssb('1108', ssb_data.get('1108'))
+		message ("%i municipalites\n" % len(municipalities))
 
-	message ("Population date: %s\n" % ", ".join(sorted(set([municipality_date, county_date, country_date]))))
+		population_date = ", ".join(sorted(set([municipality_date, county_date, country_date])))
+		message ("Population date: %s\n" % population_date)
 
 	updates = 0
 
+	# Only tags are needed to compare population if full data is loaded later for modified relations
+
+	if tags_first:
+		output = "out tags;"
+	else:
+		output = "out meta;"
+
 
 	# Load country from OSM
 	# tree_osm/root_osm will contain the updated XML for final output
@@ -109,151 +162,306 @@ if __name__ == '__main__':
 
 	message ("\nLoading country from OSM...\n")
 
-	query = '[out:xml][timeout:90];(relation["name"="Norge"]["type"="boundary"]["admin_level"="2"];);out meta;'
-	request = urllib.request.Request("https://overpass-api.de/api/interpreter?data=" + urllib.parse.quote(query), headers=request_header)
-	file = urllib.request.urlopen(request)
-	tree_osm = ET.parse(file)
-	root_osm = tree_osm.getroot()
-	file.close()
+	query = '[out:xml][timeout:90];(relation["name"="Norge"]["type"="boundary"]["admin_level"="2"];);' + output
+	with profile_phase("load_osm"):
+		tree_osm = load_overpass(query, request_header, store=store, offline=offline, backend=backend)
+		root_osm = tree_osm.getroot()
 
 	# Update country population
 
-	relation = root_osm.find("relation")
-	population_tag = relation.find("tag[@k='population']")
-	if population_tag != None:
-		population = population_tag.attrib['v']
-		if population != country['0']['population']:
-			population_tag.set("v", country['0']['population'])
+	with profile_phase("match"):
+		relation = root_osm.find("relation")
+		population_tag = relation.find("tag[@k='population']")
+		if population_tag != None:
+			population = population_tag.attrib['v']
+			if population != country['0']['population']:
+				population_tag.set("v", country['0']['population'])
+				relation.set("action", "modify")
+				updates += 1
+
+		else:
+			relation.append(ET.Element("tag", k="population", v=country['0']['population']))
 			relation.set("action", "modify")
 			updates += 1
 
-	else:
-		relation.append(ET.Element("tag", k="population", v=country['0']['population']))
-		relation.set("action", "modify")
-		updates += 1
+		# Add record date
 
-	# Add record date
-
-	date_tag = relation.find("tag[@k='population:date']")
-	if date_tag != None:
-		old_date = date_tag.attrib['v']
-		if old_date != country_date:
-			date_tag.set("v", country_date)
-			relation.set("action", "modify")
-	else:
-		relation.append(ET.Element("tag", k="population:date", v=country_date))
-		relation.set("action", "modify")		
+		date_tag = relation.find("tag[@k='population:date']")
+		if date_tag != None:
+			old_date = date_tag.attrib['v']
+			if old_date != country_date:
+				date_tag.set("v", country_date)
+				relation.set("action", "modify")
+		else:
+			relation.append(ET.Element("tag", k="population:date", v=country_date))
+			relation.set("action", "modify")		
 
 
 	# Load all counties from OSM
 
 	message ("\nLoading counties from OSM...\n")
 
-	query = '[out:xml][timeout:90];(area["name"="Norge"]["type"="boundary"];)->.a;(relation["place"="county"](area.a););out meta;'
-	request = urllib.request.Request("https://overpass-api.de/api/interpreter?data=" + urllib.parse.quote(query), headers=request_header)
-	file = urllib.request.urlopen(request)
-	tree = ET.parse(file)
-	root = tree.getroot()
-	file.close()
+	query = '[out:xml][timeout:90];(area["name"="Norge"]["type"="boundary"];)->.a;(relation["place"="county"](area.a););' + output
+	with profile_phase("load_osm"):
+		tree = load_overpass(query, request_header, store=store, offline=offline, backend=backend)
+		root = tree.getroot()
 
 	# Loop counties and update population
 
-	for relation in root.iter("relation"):
-		ref_tag = relation.find("tag[@k='ref']")
-		if ref_tag != None:
-			ref = ref_tag.attrib['v']
-			if ref in counties:
-
-				population_tag = relation.find("tag[@k='population']")
-				if population_tag != None:
-					population = population_tag.attrib['v']
-					if population != counties[ref]['population']:
-						population_tag.set("v", counties[ref]['population'])
+	with profile_phase("match"):
+		for relation in root.iter("relation"):
+			ref_tag = relation.find("tag[@k='ref']")
+			if ref_tag != None:
+				ref = ref_tag.attrib['v']
+				if ref in counties:
+
+					population_tag = relation.find("tag[@k='population']")
+					if population_tag != None:
+						population = population_tag.attrib['v']
+						if population != counties[ref]['population']:
+							population_tag.set("v", counties[ref]['population'])
+							relation.set("action", "modify")
+							updates += 1
+					else:
+						relation.append(ET.Element("tag", k="population", v=counties[ref]['population']))
 						relation.set("action", "modify")
 						updates += 1
-				else:
-					relation.append(ET.Element("tag", k="population", v=counties[ref]['population']))
-					relation.set("action", "modify")
-					updates += 1
-
-				date_tag = relation.find("tag[@k='population:date']")
-				if date_tag != None:
-					old_date = date_tag.attrib['v']
-					if old_date != county_date:
-						date_tag.set("v", county_date)
+
+					date_tag = relation.find("tag[@k='population:date']")
+					if date_tag != None:
+						old_date = date_tag.attrib['v']
+						if old_date != county_date:
+							date_tag.set("v", county_date)
+							relation.set("action", "modify")
+					else:
+						relation.append(ET.Element("tag", k="population:date", v=county_date))
 						relation.set("action", "modify")
-				else:
-					relation.append(ET.Element("tag", k="population:date", v=county_date))
-					relation.set("action", "modify")
 
-				del counties[ref]
-			else:
-				message ("County ref %s not found in SSB table\n" % ref)
+					del counties[ref]
+				else:
+					message ("County ref %s not found in SSB table\n" % ref)
 
-		root_osm.append(relation)
+			root_osm.append(relation)
 
-	for ref, county in iter(counties.items()):
-		message ("County %s %s not found in OSM\n" % (ref, county['name']))
+		for ref, county in iter(counties.items()):
+			message ("County %s %s not found in OSM\n" % (ref, county['name']))
 
 
 	# Load all municipalities from OSM
 
 	message ("\nLoading municipalities from OSM...\n")
 
-	query = '[out:xml][timeout:90];(area["name"="Norge"]["type"="boundary"];)->.a;(relation["place"="municipality"](area.a););out meta;'
-	request = urllib.request.Request("https://overpass-api.de/api/interpreter?data=" + urllib.parse.quote(query), headers=request_header)
-	file = urllib.request.urlopen(request)
-	tree = ET.parse(file)
-	root = tree.getroot()
-	file.close()
+	query = '[out:xml][timeout:90];(area["name"="Norge"]["type"="boundary"];)->.a;(relation["place"="municipality"](area.a););' + output
+	with profile_phase("load_osm"):
+		tree = load_overpass(query, request_header, store=store, offline=offline, backend=backend)
+		root = tree.getroot()
 
 	# Loop municipalities and update population
 
-	for relation in root.iter("relation"):
-		ref_tag = relation.find("tag[@k='ref']")
-		if ref_tag != None:
-			ref = ref_tag.attrib['v']
-			if ref in municipalities:
-
-				population_tag = relation.find("tag[@k='population']")
-				if population_tag != None:
-					population = population_tag.attrib['v']
-					if population != municipalities[ref]['population']:
-						population_tag.set("v", municipalities[ref]['population'])
+	with profile_phase("match"):
+		for relation in root.iter("relation"):
+			ref_tag = relation.find("tag[@k='ref']")
+			if ref_tag != None:
+				ref = ref_tag.attrib['v']
+				if ref in municipalities:
+
+					population_tag = relation.find("tag[@k='population']")
+					if population_tag != None:
+						population = population_tag.attrib['v']
+						if population != municipalities[ref]['population']:
+							population_tag.set("v", municipalities[ref]['population'])
+							relation.set("action", "modify")
+							updates += 1
+					else:
+						relation.append(ET.Element("tag", k="population", v=municipalities[ref]['population']))
 						relation.set("action", "modify")
 						updates += 1
-				else:
-					relation.append(ET.Element("tag", k="population", v=municipalities[ref]['population']))
-					relation.set("action", "modify")
-					updates += 1
-
-				date_tag = relation.find("tag[@k='population:date']")
-				if date_tag != None:
-					old_date = date_tag.attrib['v']
-					if old_date != municipality_date:
-						date_tag.set("v", municipality_date)
+
+					date_tag = relation.find("tag[@k='population:date']")
+					if date_tag != None:
+						old_date = date_tag.attrib['v']
+						if old_date != municipality_date:
+							date_tag.set("v", municipality_date)
+							relation.set("action", "modify")
+					else:
+						relation.append(ET.Element("tag", k="population:date", v=municipality_date))
 						relation.set("action", "modify")
+
+					del municipalities[ref]
 				else:
-					relation.append(ET.Element("tag", k="population:date", v=municipality_date))
-					relation.set("action", "modify")
+					message ("Municipality ref %s not found in SSB table\n" % ref)
 
-				del municipalities[ref]
-			else:
-				message ("Municipality ref %s not found in SSB table\n" % ref)
+			root_osm.append(relation)
 
-		root_osm.append(relation)
+		for ref, municipality in iter(municipalities.items()):
+			message ("Municipality %s %s not found in OSM\n" % (ref, municipality['name']))
 
-	for ref, municipality in iter(municipalities.items()):
-		message ("Municipality %s %s not found in OSM\n" % (ref, municipality['name']))
 
+	# Load full data for modified relations
 
-	# Produce output file
+	if tags_first:
+		message ("\nLoading %i modified relations from OSM...\n" % len(root_osm.findall("relation[@action='modify']")))
+		with profile_phase("load_osm"):
+			tree_osm = load_modified(tree_osm, request_header, backend)
 
-	filename = "Update_population.osm"
+
+	# Produce output file
 
 	message ("\nUpdated %i population tags\n" % updates)
-	message ("Saving file '%s'\n\n" % filename)
 
-	root_osm.set("generator", "population2osm v%s" % version)
-	root_osm.set("upload", "false")
-	tree_osm.write(filename, encoding='utf-8', method='xml', xml_declaration=True)
+	with profile_phase("write"):
+		if split:
+			filenames = split_osm(tree_osm, filename, "population2osm v%s" % version, split, county_ref)
+			message ("Saving %i files '%s'\n\n" % (len(filenames), "', '".join(filenames)))
+		else:
+			message ("Saving file '%s'\n\n" % filename)
+			save_osm(tree_osm, filename, "population2osm v%s" % version)
+
+	# Upload to OSM
+
+	if upload:
+		message ("Uploading to %s ...\n" % api)
+		with profile_phase("upload"):
+			changeset_tags = {
+				'created_by': "population2osm v%s" % version,
+				'comment': "Update population of Norwegian municipalities, counties and country",
+				'source': "SSB",
+				'population:date': population_date
+			}
+			changeset_id, uploaded, skipped = upload_osm(tree_osm, api, os.environ['OSM_ACCESS_TOKEN'], request_header, changeset_tags, upload)
+		message ("Uploaded %i elements in changeset %s, %i elements with working tags not uploaded\n\n" % (uploaded, changeset_id, skipped))
+
+	return updates, population_date
+
+
+
+# Get updated time of the SSB datasets from the list of all datasets, which is much smaller than the datasets
+# Returns dict of dataset -> updated time
+
+def ssb_updated ():
+
+	data = load_json(ssb_list_url, request_header)
+
+	updated = {}
+	for dataset in data['datasets']:
+		if dataset['id'] in ssb_datasets:
+			updated[ dataset['id'] ] = dataset['updated']
+
+	return updated
+
+
+
+# Poll SSB dataset list at given interval and run update when SSB publishes new or corrected numbers
+# The datasets are only loaded when their updated time in the dataset list has changed
+# Each update is saved to a timestamped file, and the notification file is rewritten
+# Loaded SSB data is reused for the update, so SSB is only loaded once per poll
+# Any error is logged and polling continues, only Ctrl-C stops watching
+
+def watch_ssb (interval):
+
+	last_versions = {}
+	if os.path.isfile(notification_filename):
+		file = open(notification_filename)
+		last_versions = json.load(file)['ssb_versions']
+		file.close()
+
+	last_updated = {}
+
+	message ("Watching SSB every %i minutes, press Ctrl-C to stop\n\n" % interval)
+
+	while True:
+		try:
+			updated = ssb_updated()
+			if len(updated) < len(ssb_datasets) or updated != last_updated:
+				ssb_data = {}
+				versions = {}
+				for api_ref in ssb_datasets:
+					ssb_data[ api_ref ] = load_json(ssb_url % api_ref, request_header)
+					versions[ api_ref ] = ssb_version(ssb_data[ api_ref ])
+			else:
+				versions = last_versions
+
+			if versions != last_versions:
+				message ("%s: New SSB data\n" % time.strftime("%Y-%m-%d %H:%M:%S"))
+
+				timestamp = time.strftime("%Y%m%d-%H%M%S")
+				filename = "Update_population_%s.osm" % timestamp
+				updates, population_date = update_population(ssb_data, filename)
+
+				notification = {
+					'time': timestamp,
+					'filename': filename,
+					'updates': updates,
+					'population_date': population_date,
+					'ssb_versions': versions
+				}
+				file = open(notification_filename, "w")
+				json.dump(notification, file, indent=2)
+				file.close()
+
+				last_versions = versions
+			else:
+				message ("%s: No changes\n" % time.strftime("%Y-%m-%d %H:%M:%S"))
+
+			last_updated = updated
+
+		except Exception as error:
+			message ("%s: *** Update failed: %s: %s\n" % (time.strftime("%Y-%m-%d %H:%M:%S"), type(error).__name__, error))
+
+		time.sleep(interval * 60)
+
+
+
+# Main program
+
+if __name__ == '__main__':
+
+	parser = argparse.ArgumentParser(description="Update population of Norwegian municipalities, counties and country from SSB")
+	parser.add_argument("--watch", type=int, nargs="?", const=15, metavar="minutes",
+						help="poll SSB at given interval (default 15 minutes) and update when new numbers are published")
+	parser.add_argument("--store", nargs="?", const=store_filename, metavar="filename",
+						help="keep OSM relations in local snapshot store (default %s)" % store_filename)
+	parser.add_argument("--offline", action="store_true", help="load OSM relations from snapshot store only")
+	parser.add_argument("--split", type=int, nargs="?", const=100, metavar="elements",
+						help="split output into files of at most given number of modified elements (default 100), grouped by county")
+	parser.add_argument("--upload", type=int, nargs="?", const=100, metavar="elements",
+						help="upload modified elements to OSM in diffs of given size (default 100), with access token in OSM_ACCESS_TOKEN")
+	parser.add_argument("--api", default=api_url, metavar="url", help="OSM API for upload (default %s)" % api_url)
+	parser.add_argument("--profile", action="store_true", help="save cProfile and memory profile of each phase")
+	parser.add_argument("--parser", choices=parser_backends, default="json",
+						help="parser of OSM data from Overpass (default json), lxml must be installed")
+	parser.add_argument("--tags-first", action="store_true",
+						help="compare population tags first and load full data only for modified relations")
+	args = parser.parse_args()
+
+	if args.parser == "lxml" and lxml_etree is None:
+		parser.error("--parser lxml requires lxml to be installed")
+
+	if args.tags_first and (args.store or args.offline):
+		parser.error("--tags-first cannot be used with --store or --offline")
+
+	if args.upload and not os.environ.get("OSM_ACCESS_TOKEN"):
+		sys.exit("*** Please set OSM_ACCESS_TOKEN to an OAuth 2 access token for upload\n")
+
+	if args.profile:
+		enable_profile("profile_population2osm")
+
+	split = args.split
+	upload = args.upload
+	api = args.api
+	tags_first = args.tags_first
+	backend = args.parser
+
+	if args.store or args.offline:
+		store = open_store(args.store or store_filename)
+		offline = args.offline
+
+	message ("\nQuarterly update population of Norwegian municipalities, counties and country\n\n")
+
+	if args.watch:
+		try:
+			watch_ssb(args.watch)
+		except KeyboardInterrupt:
+			message ("\nStopped watching SSB\n\n")
+	else:
+		update_population({}, "Update_population.osm")
@@ -3,14 +3,15 @@
 
 # population2osm
 # Extracts most recent quarterly population numbers from SCB and produces OSM file for import/update of Swedish municipalities, counties and country
-# Usage: population2osm_sweden.py (no arguments)
+# Usage: population2osm_sweden.py [--store [filename]] [--offline] [--split [elements]] [--upload [elements]] [--api url] [--profile] [--parser json|lxml|xml] [--tags-first]
 
 
 import sys
-import json
-import urllib.parse
-import urllib.request
+import os
+import argparse
 from xml.etree import ElementTree as ET
+from osm_tools import load_json, load_overpass, save_osm, open_store, store_filename, split_osm, upload_osm, api_url, load_modified
+from osm_tools import enable_profile, profile_phase, parser_backends, lxml_etree
 
 
 version = "0.4.0"
@@ -37,10 +38,7 @@ def load_municipalities():
 	# Load predefined data from SCB api
 
 	url = "https://catalog.skl.se/rowstore/dataset/b80d412c-9a81-4de3-a62c-724192295677?_limit=400"
-	request = urllib.request.Request(url, headers=request_header)
-	file = urllib.request.urlopen(request)
-	data = json.load(file)
-	file.close()
+	data = load_json(url, request_header)
 
 	# Determine record date of population numbers
 
@@ -76,15 +74,60 @@ def load_municipalities():
 
 
 
+# Get county ref of county or municipality relation, used to keep counties together when splitting output
+
+def county_ref (relation):
+
+	for key in ["ref:se:scb", "ref"]:
+		ref_tag = relation.find("tag[@k='%s']" % key)
+		if ref_tag != None and ref_tag.attrib['v'].isdigit():
+			return ref_tag.attrib['v'][:2]
+	return ""
+
+
+
 # Main program
 
 if __name__ == '__main__':
 
+	parser = argparse.ArgumentParser(description="Update population of Swedish municipalities, counties and country from SCB")
+	parser.add_argument("--store", nargs="?", const=store_filename, metavar="filename",
+						help="keep OSM relations in local snapshot store (default %s)" % store_filename)
+	parser.add_argument("--offline", action="store_true", help="load OSM relations from snapshot store only")
+	parser.add_argument("--split", type=int, nargs="?", const=100, metavar="elements",
+						help="split output into files of at most given number of modified elements (default 100), grouped by county")
+	parser.add_argument("--upload", type=int, nargs="?", const=100, metavar="elements",
+						help="upload modified elements to OSM in diffs of given size (default 100), with access token in OSM_ACCESS_TOKEN")
+	parser.add_argument("--api", default=api_url, metavar="url", help="OSM API for upload (default %s)" % api_url)
+	parser.add_argument("--profile", action="store_true", help="save cProfile and memory profile of each phase")
+	parser.add_argument("--parser", choices=parser_backends, default="json",
+						help="parser of OSM data from Overpass (default json), lxml must be installed")
+	parser.add_argument("--tags-first", action="store_true",
+						help="compare population tags first and load full data only for modified relations")
+	args = parser.parse_args()
+
+	if args.parser == "lxml" and lxml_etree is None:
+		parser.error("--parser lxml requires lxml to be installed")
+
+	if args.tags_first and (args.store or args.offline):
+		parser.error("--tags-first cannot be used with --store or --offline")
+
+	if args.upload and not os.environ.get("OSM_ACCESS_TOKEN"):
+		sys.exit("*** Please set OSM_ACCESS_TOKEN to an OAuth 2 access token for upload\n")
+
+	if args.profile:
+		enable_profile("profile_population2osm_sweden")
+
+	store = None
+	if args.store or args.offline:
+		store = open_store(args.store or store_filename)
+
 	message ("\nAnnual update population of Swedish municipalities, counties and country\n\n")
 
 	# Load all SCB population data
 
-	entities, date = load_municipalities()
+	with profile_phase("load_scb"):
+		entities, date = load_municipalities()
 	message ("Population date: %s\n" % date)
 	message ("Sweden population: %s\n" % entities['0']['population'])
 
@@ -106,150 +149,162 @@ if __name__ == '__main__':
 
 	updates = 0
 
+	# Only tags are needed to compare population if full data is loaded later for modified relations
+
+	if args.tags_first:
+		output = "out tags;"
+	else:
+		output = "out meta;"
+
 
 	# Load country from OSM
 	# tree_osm/root_osm will contain the updated XML for final output
 
 	message ("\nLoading country from OSM...\n")
 
-	query = '[out:xml][timeout:200];(relation["name"="Sverige"]["type"="boundary"]["admin_level"="2"];);out meta;'
-	request = urllib.request.Request("https://overpass-api.de/api/interpreter?data=" + urllib.parse.quote(query), headers=request_header)
-	file = urllib.request.urlopen(request)
-	tree_osm = ET.parse(file)
-	root_osm = tree_osm.getroot()
-	file.close()
+	query = '[out:xml][timeout:200];(relation["name"="Sverige"]["type"="boundary"]["admin_level"="2"];);' + output
+	with profile_phase("load_osm"):
+		tree_osm = load_overpass(query, request_header, store=store, offline=args.offline, backend=args.parser)
+		root_osm = tree_osm.getroot()
 
 	# Update country population
 
-	relation = root_osm.find("relation")
-	population_tag = relation.find("tag[@k='population']")
-	if population_tag != None:
-		population = population_tag.attrib['v']
-		if population != str(country['0']['population']):
-			population_tag.set("v", str(entities['0']['population']))
+	with profile_phase("match"):
+		relation = root_osm.find("relation")
+		population_tag = relation.find("tag[@k='population']")
+		if population_tag != None:
+			population = population_tag.attrib['v']
+			if population != str(country['0']['population']):
+				population_tag.set("v", str(entities['0']['population']))
+				relation.set("action", "modify")
+				updates += 1
+
+		else:
+			relation.append(ET.Element("tag", k="population", v=str(entities['0']['population'])))
 			relation.set("action", "modify")
 			updates += 1
 
-	else:
-		relation.append(ET.Element("tag", k="population", v=str(entities['0']['population'])))
-		relation.set("action", "modify")
-		updates += 1
+		# Add record date
 
-	# Add record date
-
-	date_tag = relation.find("tag[@k='population:date']")
-	if date_tag != None:
-		old_date = date_tag.attrib['v']
-		if old_date != date:
-			date_tag.set("v", date)
-			relation.set("action", "modify")
-	else:
-		relation.append(ET.Element("tag", k="population:date", v=date))
-		relation.set("action", "modify")		
+		date_tag = relation.find("tag[@k='population:date']")
+		if date_tag != None:
+			old_date = date_tag.attrib['v']
+			if old_date != date:
+				date_tag.set("v", date)
+				relation.set("action", "modify")
+		else:
+			relation.append(ET.Element("tag", k="population:date", v=date))
+			relation.set("action", "modify")		
 
 
 	# Load all counties from OSM
 
 	message ("\nLoading counties from OSM...\n")
 
-	query = '[out:xml][timeout:200];(area["name"="Sverige"]["type"="boundary"];)->.a;(relation["admin_level"="4"](area.a););out meta;'
-	request = urllib.request.Request("https://overpass-api.de/api/interpreter?data=" + urllib.parse.quote(query), headers=request_header)
-	file = urllib.request.urlopen(request)
-	tree = ET.parse(file)
-	root = tree.getroot()
-	file.close()
+	query = '[out:xml][timeout:200];(area["name"="Sverige"]["type"="boundary"];)->.a;(relation["admin_level"="4"](area.a););' + output
+	with profile_phase("load_osm"):
+		tree = load_overpass(query, request_header, store=store, offline=args.offline, backend=args.parser)
+		root = tree.getroot()
 
 	# Loop counties and update population
 
-	for relation in root.iter("relation"):
-		ref_tag = relation.find("tag[@k='ref:se:scb']")
-		if ref_tag != None:
-			ref = ref_tag.attrib['v']
-			if ref in entities:
-
-				population_tag = relation.find("tag[@k='population']")
-				if population_tag != None:
-					population = population_tag.attrib['v']
-					if population != str(entities[ref]['population']):
-						population_tag.set("v", str(counties[ref]['population']))
+	with profile_phase("match"):
+		for relation in root.iter("relation"):
+			ref_tag = relation.find("tag[@k='ref:se:scb']")
+			if ref_tag != None:
+				ref = ref_tag.attrib['v']
+				if ref in entities:
+
+					population_tag = relation.find("tag[@k='population']")
+					if population_tag != None:
+						population = population_tag.attrib['v']
+						if population != str(entities[ref]['population']):
+							population_tag.set("v", str(counties[ref]['population']))
+							relation.set("action", "modify")
+							updates += 1
+					else:
+						relation.append(ET.Element("tag", k="population", v=str(entities[ref]['population'])))
 						relation.set("action", "modify")
 						updates += 1
-				else:
-					relation.append(ET.Element("tag", k="population", v=str(entities[ref]['population'])))
-					relation.set("action", "modify")
-					updates += 1
-
-				date_tag = relation.find("tag[@k='population:date']")
-				if date_tag != None:
-					old_date = date_tag.attrib['v']
-					if old_date != date:
-						date_tag.set("v", date)
+
+					date_tag = relation.find("tag[@k='population:date']")
+					if date_tag != None:
+						old_date = date_tag.attrib['v']
+						if old_date != date:
+							date_tag.set("v", date)
+							relation.set("action", "modify")
+					else:
+						relation.append(ET.Element("tag", k="population:date", v=date))
 						relation.set("action", "modify")
-				else:
-					relation.append(ET.Element("tag", k="population:date", v=date))
-					relation.set("action", "modify")
 
-				del entities[ref]
-			else:
-				message ("County ref %s not found in population data\n" % ref)
+					del entities[ref]
+				else:
+					message ("County ref %s not found in population data\n" % ref)
 
-		root_osm.append(relation)
+			root_osm.append(relation)
 
-	for ref, county in iter(entities.items()):
-		if len(ref) == 2:
-			message ("County %s %s not found in OSM\n" % (ref, county['name']))
+		for ref, county in iter(entities.items()):
+			if len(ref) == 2:
+				message ("County %s %s not found in OSM\n" % (ref, county['name']))
 
 
 	# Load all municipalities from OSM
 
 	message ("\nLoading municipalities from OSM...\n")
 
-	query = '[out:xml][timeout:200];(area["name"="Sverige"]["type"="boundary"];)->.a;(relation["admin_level"="7"](area.a););out meta;'
-	request = urllib.request.Request("https://overpass-api.de/api/interpreter?data=" + urllib.parse.quote(query), headers=request_header)
-	file = urllib.request.urlopen(request)
-	tree = ET.parse(file)
-	root = tree.getroot()
-	file.close()
+	query = '[out:xml][timeout:200];(area["name"="Sverige"]["type"="boundary"];)->.a;(relation["admin_level"="7"](area.a););' + output
+	with profile_phase("load_osm"):
+		tree = load_overpass(query, request_header, store=store, offline=args.offline, backend=args.parser)
+		root = tree.getroot()
 
 	# Loop municipalities and update population
 
-	for relation in root.iter("relation"):
-		ref_tag = relation.find("tag[@k='ref']")
-		if ref_tag != None:
-			ref = ref_tag.attrib['v']
-			if ref in entities:
-
-				population_tag = relation.find("tag[@k='population']")
-				if population_tag != None:
-					population = population_tag.attrib['v']
-					if population != str(entities[ref]['population']):
-						population_tag.set("v", str(entities[ref]['population']))
+	with profile_phase("match"):
+		for relation in root.iter("relation"):
+			ref_tag = relation.find("tag[@k='ref']")
+			if ref_tag != None:
+				ref = ref_tag.attrib['v']
+				if ref in entities:
+
+					population_tag = relation.find("tag[@k='population']")
+					if population_tag != None:
+						population = population_tag.attrib['v']
+						if population != str(entities[ref]['population']):
+							population_tag.set("v", str(entities[ref]['population']))
+							relation.set("action", "modify")
+							updates += 1
+					else:
+						relation.append(ET.Element("tag", k="population", v=str(entities[ref]['population'])))
 						relation.set("action", "modify")
 						updates += 1
-				else:
-					relation.append(ET.Element("tag", k="population", v=str(entities[ref]['population'])))
-					relation.set("action", "modify")
-					updates += 1
-
-				date_tag = relation.find("tag[@k='population:date']")
-				if date_tag != None:
-					old_date = date_tag.attrib['v']
-					if old_date != date:
-						date_tag.set("v", date)
+
+					date_tag = relation.find("tag[@k='population:date']")
+					if date_tag != None:
+						old_date = date_tag.attrib['v']
+						if old_date != date:
+							date_tag.set("v", date)
+							relation.set("action", "modify")
+					else:
+						relation.append(ET.Element("tag", k="population:date", v=date))
 						relation.set("action", "modify")
+
+					del entities[ref]
 				else:
-					relation.append(ET.Element("tag", k="population:date", v=date))
-					relation.set("action", "modify")
+					message ("Municipality ref %s not found in population data\n" % ref)
+
+			root_osm.append(relation)
 
-				del entities[ref]
-			else:
-				message ("Municipality ref %s not found in population data\n" % ref)
+		for ref, municipality in iter(entities.items()):
+			if len(ref) == 4:
+				message ("Municipality %s %s not found in OSM\n" % (ref, municipality['name']))
 
-		root_osm.append(relation)
 
-	for ref, municipality in iter(entities.items()):
-		if len(ref) == 4:
-			message ("Municipality %s %s not found in OSM\n" % (ref, municipality['name']))
+	# Load full data for modified relations
+
+	if args.tags_first:
+		message ("\nLoading %i modified relations from OSM...\n" % len(root_osm.findall("relation[@action='modify']")))
+		with profile_phase("load_osm"):
+			tree_osm = load_modified(tree_osm, request_header, args.parser)
 
 
 	# Produce output file
@@ -257,8 +312,25 @@ if __name__ == '__main__':
 	filename = "Sweden_population.osm"
 
 	message ("\nUpdated %i population tags\n" % updates)
-	message ("Saving file '%s'\n\n" % filename)
 
-	root_osm.set("generator", "population2osm v%s" % version)
-	root_osm.set("upload", "false")
-	tree_osm.write(filename, encoding='utf-8', method='xml', xml_declaration=True)
+	with profile_phase("write"):
+		if args.split:
+			filenames = split_osm(tree_osm, filename, "population2osm v%s" % version, args.split, county_ref)
+			message ("Saving %i files '%s'\n\n" % (len(filenames), "', '".join(filenames)))
+		else:
+			message ("Saving file '%s'\n\n" % filename)
+			save_osm(tree_osm, filename, "population2osm v%s" % version)
+
+	# Upload to OSM
+
+	if args.upload:
+		message ("Uploading to %s ...\n" % args.api)
+		with profile_phase("upload"):
+			changeset_tags = {
+				'created_by': "population2osm v%s" % version,
+				'comment': "Update population of Swedish municipalities, counties and country",
+				'source': "SCB",
+				'population:date': date
+			}
+			changeset_id, uploaded, skipped = upload_osm(tree_osm, args.api, os.environ['OSM_ACCESS_TOKEN'], request_header, changeset_tags, args.upload)
+		message ("Uploaded %i elements in changeset %s, %i elements with working tags not uploaded\n\n" % (uploaded, changeset_id, skipped))
@@ -5,16 +5,24 @@
 # Extracts urban settlements with population numbers from SSB and updates OSM.
 # Produces OSM file ready for additional edits before upload, filename 'tettsted_<year>.osm'
 # Input CSV on: https://www.ssb.no/en/befolkning/statistikker/beftett.
-# Usage: urban_population2osm.py <year> <CSV filename>
+# Usage: urban_population2osm.py <year> <CSV filename> [--resume] [--restart] [--store [filename]] [--offline] [--split [elements]] [--upload [elements]] [--api url] [--profile] [--parser json|lxml|xml] [--gazetteer filename]
 
 
 import json
 import html
 import sys
+import os
 import csv
+import argparse
+import math
+import bisect
+import zipfile
+import difflib
 import urllib.request, urllib.parse, urllib.error
 from io import StringIO, TextIOWrapper
 from xml.etree import ElementTree as ET
+from osm_tools import load_json, load_overpass, save_osm, open_store, store_filename, split_osm, upload_osm, api_url
+from osm_tools import enable_profile, profile_phase, parser_backends, lxml_etree
 
 
 version = "0.3.0"
@@ -31,6 +39,24 @@ update_date = "-01-01"  # Tag to OSM
 
 source = "SSB - befolkning i tettstedet"  # Tag to OSM
 
+merge_radius = 1000  # Max distance in metres to an existing place node for it to be a merge candidate
+
+merge_similarity = 0.8  # Min name similarity (0..1) for a merge candidate
+
+grid_size = 0.02  # Cell size in degrees of spatial index for existing place nodes
+
+name_match_score = 0.8  # Min trigram similarity (0..1) for matching settlement name with place node in municipality
+
+merge_places = ['city', 'town', 'village', 'hamlet', 'suburb', 'neighbourhood', 'isolated_dwelling']  # Place types loaded from OSM and considered for merge
+
+name_match_places = ['city', 'town', 'village', 'hamlet', 'suburb', 'neighbourhood']  # Place types considered for name match
+
+name_part_places = ['city', 'town', 'village']  # Place types considered for match with part of name, e.g. "Berg" in "Berg/Dal"
+
+ssr_types_url = "https://raw.githubusercontent.com/osmno/geocode2osm/master/navnetyper.json"  # SSR name categories
+
+ssr_types_filename = "navnetyper.json"  # Local copy of SSR name categories, used with gazetteer
+
 
 # The dict below specifies how certain urban settlements will be devided into sub-areas
 # Population assignment: 'all' - total population; 'part' - only population for sub-area (one line in SSB table)
@@ -81,37 +107,367 @@ def message (line):
 
 
 
-# Geocoding with SSR
+# Select geocoding result from SSR places, given as list of (name type, latitude, longitude)
+# Returns (latitude, longitude, name type) of first acceptable place, or None if no places
+
+def ssr_result (places):
+
+	if places:
+
+		# Return the first acceptable result
+		for name_type, latitude, longitude in places:
+			if (name_type.lower().strip() in ssr_types) and \
+					(ssr_types[ name_type.lower().strip() ] in ['Bebyggelse', 'OffentligAdministrasjon', 'Kultur']):
+				return (latitude, longitude, name_type.strip())
+
+		# All place types considered if no match above
+		name_type, latitude, longitude = places[0]
+		return (latitude, longitude, name_type.strip())
+
+	return None
+
+
+
+# Normalize place name for search in gazetteer
+
+def gazetteer_key (name):
+
+	return name.replace("(","").replace(")","").strip().lower()
+
+
+
+# Get local name of XML tag without namespace
+
+def local_name (tag):
+
+	return tag.rsplit("}", 1)[-1]
+
+
+
+# Load SSR gazetteer from the Stedsnavn dataset downloaded from Geonorge in GML format with coordinates in EPSG:4258
+# The file may be the downloaded zip file or the GML file inside it
+# Name types are given as codes in the GML file, and are translated to the display names used by the SSR api
+# Returns dict of municipality number -> (sorted list of normalized names, list of (name type, latitude, longitude))
+
+def load_gazetteer (filename):
+
+	if filename.lower().endswith(".zip"):
+		archive = zipfile.ZipFile(filename)
+		gml_name = [name for name in archive.namelist() if name.lower().endswith(".gml")][0]
+		file = archive.open(gml_name)
+	else:
+		file = open(filename, "rb")
+
+	municipality_places = {}
+	root = None
+
+	for event, element in ET.iterparse(file, events=("start", "end")):
+		if root is None:
+			root = element
+		if event != "end" or local_name(element.tag) != "Sted":
+			continue
+
+		name_type = None
+		position = None
+		municipality_refs = []
+		names = []
+
+		for child in element.iter():
+			tag = local_name(child.tag)
+			if "srsName" in child.attrib and "4258" not in child.attrib['srsName']:
+				raise ValueError("Gazetteer must have coordinates in EPSG:4258, found %s" % child.attrib['srsName'])
+			if tag == "navneobjekttype" and name_type is None:
+				name_type = child.text.strip()
+			elif tag in ["pos", "posList"] and position is None:
+				position = child.text.split()[:2]  # Latitude, longitude in EPSG:4258
+			elif tag == "kommunenummer":
+				municipality_refs.append(child.text.strip())
+			elif tag == "komplettskrivemåte":
+				names.append(child.text)
+
+		root.clear()  # Remove parsed features from the tree to keep memory low
+
+		if name_type is None or position is None:
+			continue
+
+		entry = (ssr_type_names.get(name_type.lower(), name_type), position[0], position[1])
+		for name in names:
+			for municipality_ref in municipality_refs:
+				municipality_places.setdefault(municipality_ref, []).append((gazetteer_key(name), entry))
+
+	file.close()
+
+	gazetteer = {}
+	for municipality_ref, places in iter(municipality_places.items()):
+		places.sort(key=lambda place: place[0])  # Stable sort keeps order of file within each name
+		gazetteer[ municipality_ref ] = ([key for key, entry in places], [entry for key, entry in places])
+
+	return gazetteer
+
+
+
+# Search gazetteer for exact name, or for name prefix if query ends with "*"
+# Returns list of at most 10 places as (name type, latitude, longitude), like one page from the SSR api
+
+def search_gazetteer (query_text, query_municipality):
+
+	if query_municipality not in gazetteer:
+		return []
+
+	keys, places = gazetteer[ query_municipality ]
+
+	if query_text.endswith("*"):
+		prefix = gazetteer_key(query_text[:-1])
+		start = bisect.bisect_left(keys, prefix)
+		end = start
+		while end < len(keys) and end < start + 10 and keys[ end ].startswith(prefix):
+			end += 1
+	else:
+		key = gazetteer_key(query_text)
+		start = bisect.bisect_left(keys, key)
+		end = min(bisect.bisect_right(keys, key), start + 10)
+
+	return places[ start : end ]
+
+
+
+# Geocoding with SSR, using gazetteer if loaded
 # Search is within given municipality number
 
 def ssr_search (query_text, query_municipality):
 
+	if gazetteer is not None:
+		return ssr_result(search_gazetteer(query_text, query_municipality))
+
 	query = "https://ws.geonorge.no/stedsnavn/v1/navn?sok=%s&knr=%s&utkoordsys=4258&treffPerSide=10&side=1" \
 				% (urllib.parse.quote(query_text.replace("(","").replace(")","")), query_municipality)
 
-	request = urllib.request.Request(query, headers=request_header)
-	file = urllib.request.urlopen(request)
-	result = json.load(file)
-	file.close()
+	result = load_json(query, request_header)
 
-	if result['navn']:
+	places = [(place['navneobjekttype'], place['representasjonspunkt']['nord'], place['representasjonspunkt']['øst'])
+				for place in result['navn']]
 
-		# Return the first acceptable result
-		for place in result['navn']:
-			if (place['navneobjekttype'].lower().strip() in ssr_types) and \
-					(ssr_types[ place['navneobjekttype'].lower().strip() ] in ['Bebyggelse', 'OffentligAdministrasjon', 'Kultur']):
-				result_type = place['navneobjekttype'].strip()
-				return (place['representasjonspunkt']['nord'], place['representasjonspunkt']['øst'], result_type)
+	return ssr_result(places)
 
-		# All place types considered if no match above
-		place = result['navn'][0]
-		result_type = place['navneobjekttype'].strip()
-		return (place['representasjonspunkt']['nord'], place['representasjonspunkt']['øst'], result_type)
-	
+
+
+# Geocode new settlement with SSR, trying each name part within each municipality of the settlement
+# Municipality name is used as a last resort
+# Returns (result, municipality name, only municipality found)
+
+def geocode_settlement (settlement, names):
+
+	for municipality in settlement['municipalities']:
+		for settlement_name in names:
+			result = ssr_search(settlement_name, municipality['ref'])
+			if result != None:
+				return (result, municipality['name'], False)
+
+	for municipality in settlement['municipalities']:
+		result = ssr_search(municipality['name'] + "*", municipality['ref'])
+		if result != None:
+			return (result, municipality['name'], True)
+
+	return (None, "", False)
+
+
+
+# Load journal of geocoding results from an interrupted run
+# An incomplete last line from a killed run is dropped from the journal, so that new results may be appended
+# Returns dict of settlement ref -> (result, municipality name, only municipality found)
+
+def load_journal (filename):
+
+	journal = {}
+	if os.path.isfile(filename):
+		file = open(filename)
+		lines = file.readlines()
+		file.close()
+
+		if lines and (not lines[-1].endswith("\n") or not lines[-1].strip()):
+			message ("Drop incomplete last line of journal '%s'\n" % filename)
+			lines = lines[:-1]
+			file = open(filename, "w")
+			file.writelines(lines)
+			file.close()
+
+		for line in lines:
+			entry = json.loads(line)
+			journal[ entry['ref'] ] = (entry['result'], entry['municipality'], entry['only_municipality'])
+
+	return journal
+
+
+
+# Compute approximate distance in metres between two points
+
+def distance (lat1, lon1, lat2, lon2):
+
+	lat1, lon1, lat2, lon2 = map(math.radians, [lat1, lon1, lat2, lon2])
+	a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lon2 - lon1) / 2) ** 2
+	return 2 * 6371000 * math.asin(math.sqrt(a))
+
+
+
+# Compare place names, ignoring case and surrounding spaces
+# Returns similarity ratio between 0 and 1
+
+def name_similarity (name1, name2):
+
+	name1 = name1.lower().strip()
+	name2 = name2.lower().strip()
+	if name1 == name2:
+		return 1.0
+	return difflib.SequenceMatcher(None, name1, name2).ratio()
+
+
+
+# Grid cell of spatial index for given coordinates
+
+def grid_cell (latitude, longitude):
+
+	return (int(math.floor(latitude / grid_size)), int(math.floor(longitude / grid_size)))
+
+
+
+# Build spatial grid index of existing OSM place nodes
+# Returns dict of grid cell -> list of nodes
+
+def build_place_index (place_nodes):
+
+	place_index = {}
+
+	for node in place_nodes:
+		cell = grid_cell(float(node.attrib['lat']), float(node.attrib['lon']))
+		if cell not in place_index:
+			place_index[cell] = []
+		place_index[cell].append(node)
+
+	return place_index
+
+# Find closest existing place node of merge_places types within merge radius with a name similar to one of the given names
+
+# Find closest existing place node within merge radius with a name similar to one of the given names
+# Only grid cells within the radius are searched. Returns (node, distance) or None
+
+def find_merge_candidate (place_index, latitude, longitude, names):
+
+	lat_cells = int(math.ceil(merge_radius / 111320.0 / grid_size))
+	lon_cells = int(math.ceil(merge_radius / (111320.0 * math.cos(math.radians(latitude))) / grid_size))
+	lat_cell, lon_cell = grid_cell(latitude, longitude)
+
+	best_node = None
+	best_score = None
+
+	for y in range(lat_cell - lat_cells, lat_cell + lat_cells + 1):
+		for x in range(lon_cell - lon_cells, lon_cell + lon_cells + 1):
+			for node in place_index.get((y, x), []):
+				if node in used_places or node.find("tag[@k='place']").attrib['v'] not in merge_places:
+					continue
+				node_distance = distance(latitude, longitude, float(node.attrib['lat']), float(node.attrib['lon']))
+				if node_distance <= merge_radius:
+					node_name = node.find("tag[@k='name']").attrib['v']
+					similarity = max(name_similarity(name, node_name) for name in names)
+					if similarity >= merge_similarity and (best_score is None or (similarity, -node_distance) > best_score):
+						best_node = node
+						best_score = (similarity, -node_distance)
+
+	if best_node is not None:
+		return (best_node, -best_score[1])
 	return None
 
 
 
+# Normalize name for comparison
+
+def normalize_name (name):
+
+	return " ".join(name.lower().split())
+
+
+
+# Get set of character trigrams of name, with space padding to weight start and end of name
+
+def trigrams (name):
+
+	name = " %s " % normalize_name(name)
+	return set(name[ i : i + 3 ] for i in range(len(name) - 2))
+
+
+
+# Build trigram index of names of existing OSM place nodes within each municipality
+# Parameter municipality_places is dict of municipality ref -> list of place nodes
+# Returns dict of municipality ref -> dict of trigram -> list of (node, number of trigrams in node name)
+
+def build_name_index (municipality_places):
+
+	name_index = {}
+
+	for municipality_ref, nodes in iter(municipality_places.items()):
+		index = {}
+		for node in nodes:
+			if node.find("tag[@k='place']").attrib['v'] in name_match_places:
+				node_trigrams = trigrams(node.find("tag[@k='name']").attrib['v'])
+				for trigram in node_trigrams:
+					if trigram not in index:
+						index[ trigram ] = []
+					index[ trigram ].append((node, len(node_trigrams)))
+		name_index[ municipality_ref ] = index
+
+	return name_index
+
+
+
+# Find place node in the municipalities of a settlement with the most similar name (Dice coefficient of trigrams)
+# Each of the given names is tried, and only matches with at least name_match_score are considered
+# The first name is the full settlement name, the other names are parts which only match name_part_places
+# Returns (node, score) or None
+
+def find_name_match (name_index, settlement, names):
+
+	best_node = None
+	best_score = None
+
+	for municipality in settlement['municipalities']:
+		index = name_index.get(municipality['ref'], {})
+
+		for name_number, name in enumerate(names):
+			name_trigrams = trigrams(name)
+			counts = {}
+			for trigram in name_trigrams:
+				for node, node_size in index.get(trigram, []):
+					if node not in used_places and \
+							(name_number == 0 or node.find("tag[@k='place']").attrib['v'] in name_part_places):
+						if node not in counts:
+							counts[ node ] = [0, node_size]
+						counts[ node ][0] += 1
+
+			# Lowest node id is chosen if equal scores, to get the same result every run
+
+			for node, (count, node_size) in iter(counts.items()):
+				score = 2.0 * count / (len(name_trigrams) + node_size)
+				if score >= name_match_score and (best_score is None or (score, -int(node.attrib['id'])) > best_score):
+					best_node = node
+					best_score = (score, -int(node.attrib['id']))
+
+	if best_node is not None:
+		return (best_node, best_score[0])
+	return None
+
+
+
+# Add settlement ref and population to existing place node, which will not be considered again for other settlements
+
+def update_place (node, settlement_ref, settlement):
+
+	update_tag (node, "ref:ssb_tettsted", settlement_ref)
+	update_tag (node, "population", settlement['population'])
+	update_tag (node, "population:date", update_date)
+	update_tag (node, "source:population", source)
+	used_places.add(node)
+
+
+
 # Add or update tag of OSM element
 # Return True if tag was modified
 
@@ -131,66 +487,180 @@ def update_tag (element, key, value):
 
 
 
+# Get county ref of settlement from its first municipality, used to keep counties together when splitting output
+
+def settlement_county (element):
+
+	ref_tag = element.find("tag[@k='ref:ssb_tettsted']")
+	if ref_tag != None and ref_tag.attrib['v'] in ssb_settlements and ssb_settlements[ ref_tag.attrib['v'] ]['municipalities']:
+		return ssb_settlements[ ref_tag.attrib['v'] ]['municipalities'][0]['ref'][:2]
+	return ""
+
+
+
 # Main program
 
 if __name__ == '__main__':
 
 	message ("\n*** Urban settlements ('tettsteder') population update ***\n")
 
-	if len(sys.argv) == 3:
-		update_year = sys.argv[1]
-		update_date = update_year + update_date
-		csv_filename = sys.argv[2]
-	else:
-		sys.exit("*** Please enter parameters 1) update year and 2) CSV file name from SSB\n")
+	parser = argparse.ArgumentParser(description="Update population of urban settlements from SSB")
+	parser.add_argument("year", help="update year")
+	parser.add_argument("csv_filename", help="CSV file name from SSB")
+	parser.add_argument("--resume", action="store_true", help="resume interrupted run, reusing geocoding results from journal")
+	parser.add_argument("--restart", action="store_true", help="discard journal of interrupted run and geocode all settlements again")
+	parser.add_argument("--store", nargs="?", const=store_filename, metavar="filename",
+						help="keep OSM place objects in local snapshot store (default %s)" % store_filename)
+	parser.add_argument("--offline", action="store_true", help="load OSM place objects from snapshot store only")
+	parser.add_argument("--split", type=int, nargs="?", const=100, metavar="elements",
+						help="split output into files of at most given number of modified elements (default 100), grouped by county")
+	parser.add_argument("--upload", type=int, nargs="?", const=100, metavar="elements",
+						help="upload modified elements to OSM in diffs of given size (default 100), with access token in OSM_ACCESS_TOKEN")
+	parser.add_argument("--api", default=api_url, metavar="url", help="OSM API for upload (default %s)" % api_url)
+	parser.add_argument("--profile", action="store_true", help="save cProfile and memory profile of each phase")
+	parser.add_argument("--parser", choices=parser_backends, default="json",
+						help="parser of OSM data from Overpass (default json), lxml must be installed")
+	parser.add_argument("--gazetteer", metavar="filename",
+						help="geocode with Stedsnavn GML file (or zip) downloaded from Geonorge instead of the SSR api")
+	args = parser.parse_args()
+
+	if args.parser == "lxml" and lxml_etree is None:
+		parser.error("--parser lxml requires lxml to be installed")
+
+	if args.upload and not os.environ.get("OSM_ACCESS_TOKEN"):
+		sys.exit("*** Please set OSM_ACCESS_TOKEN to an OAuth 2 access token for upload\n")
+
+	if args.profile:
+		enable_profile("profile_urban_population2osm")
+
+	store = None
+	if args.store or args.offline:
+		store = open_store(args.store or store_filename)
+
+	update_year = args.year
+	update_date = update_year + update_date
+	csv_filename = args.csv_filename
 
 	message ("Update date: %s\n" % update_date)
 
+	# Geocoding results are written to a journal as they complete, to be reused if the run is resumed
+
+	journal_filename = "tettsted_%s.journal" % update_year
+
+	if args.resume:
+		journal = load_journal(journal_filename)
+		message ("Resume with %i geocoded settlements from '%s'\n" % (len(journal), journal_filename))
+		journal_file = open(journal_filename, "a")
+	elif os.path.isfile(journal_filename) and not args.restart:
+		sys.exit("\n*** Journal '%s' of interrupted run exists, please use --resume to continue or --restart to discard it\n" % journal_filename)
+	else:
+		journal = {}
+		journal_file = open(journal_filename, "w")
+
 
 	# Load SSR name categories from Github
+	# A local copy is kept when using the gazetteer, to be able to geocode without network access
 
-	ssr_filename = 'https://raw.githubusercontent.com/osmno/geocode2osm/master/navnetyper.json'
-	file = urllib.request.urlopen(ssr_filename)
-	name_codes = json.load(file)
-	file.close()
+	if args.gazetteer and os.path.isfile(ssr_types_filename):
+		file = open(ssr_types_filename, encoding="utf-8")
+		name_codes = json.load(file)
+		file.close()
+	else:
+		name_codes = load_json(ssr_types_url, request_header)
+		if args.gazetteer:
+			file = open(ssr_types_filename, "w", encoding="utf-8")
+			json.dump(name_codes, file, ensure_ascii=False)
+			file.close()
 
 	ssr_types = {}
+	ssr_type_names = {}  # Name type code -> display name
 	for main_group in name_codes['navnetypeHovedgrupper']:
 		for group in main_group['navnetypeGrupper']:
 			for name_type in group['navnetyper']:
 				ssr_types[ name_type['visningsnavn'].strip().lower() ] = main_group['navn']
+				ssr_type_names[ name_type['visningsnavn'].strip().lower() ] = name_type['visningsnavn'].strip()
+				if "navn" in name_type:
+					ssr_type_names[ name_type['navn'].strip().lower() ] = name_type['visningsnavn'].strip()
+
+	# Load SSR gazetteer for geocoding without the SSR api
+
+	gazetteer = None
+	if args.gazetteer:
+		message ("Load SSR gazetteer '%s' ... " % args.gazetteer)
+		with profile_phase("load_gazetteer"):
+			gazetteer = load_gazetteer(args.gazetteer)
+			message ("%i places in %i municipalities\n" % (sum(len(keys) for keys, places in gazetteer.values()), len(gazetteer)))
 
 
 	# Load existing urban areas from OSM
 
 	message ("\nLoad existing urban places from OSM ... ")
 
-	query = '[out:xml][timeout:90];(area["name"="Norge"]["type"="boundary"];)->.a;(nwr["ref:ssb_tettsted"](area.a););(._;>;);out meta;'
-	request = urllib.request.Request("https://overpass-api.de/api/interpreter?data=" + urllib.parse.quote(query), headers=request_header)
-	file = urllib.request.urlopen(request)
-	osm_tree = ET.parse(file)
-	osm_root = osm_tree.getroot()
-	file.close()
+	with profile_phase("load_osm"):
+		query = '[out:xml][timeout:90];(area["name"="Norge"]["type"="boundary"];)->.a;(nwr["ref:ssb_tettsted"](area.a););(._;>;);out meta;'
+		osm_tree = load_overpass(query, request_header, store=store, offline=args.offline, backend=args.parser)
+		osm_root = osm_tree.getroot()
 
-	osm_settlements = {}
-	osm_count = 0
-	duplicate = False
-
-	for settlement in osm_root:
-		ref_tag = settlement.find("tag[@k='ref:ssb_tettsted']")
-		if ref_tag != None:
-			ref = ref_tag.attrib['v']
-			if ref in osm_settlements:
-				message ("\n\tDuplicate 'ref:ssb_tettsted': %s  " % ref)
-				duplicate = True
-			else:
-				osm_settlements[ref] = settlement
-				osm_count += 1
+		osm_settlements = {}
+		osm_count = 0
+		duplicate = False
+
+		for settlement in osm_root:
+			ref_tag = settlement.find("tag[@k='ref:ssb_tettsted']")
+			if ref_tag != None:
+				ref = ref_tag.attrib['v']
+				if ref in osm_settlements:
+					message ("\n\tDuplicate 'ref:ssb_tettsted': %s  " % ref)
+					duplicate = True
+				else:
+					osm_settlements[ref] = settlement
+					osm_count += 1
+
+		message ("%s settlements\n" % osm_count)
+
+		if duplicate:
+			sys.exit ("\n*** Please remove duplicates from OSM before continuing\n")
+
+
+		# Load existing place nodes without settlement ref from OSM, to be considered for merging with new settlements
+		# The place nodes are loaded with out meta; to be refreshed incrementally in the snapshot store,
+		# while the place nodes of each municipality are loaded as ids only, each municipality area followed by its nodes
+
+		message ("Load other place nodes from OSM ... ")
 
-	message ("%s settlements\n" % osm_count)
+		query = '[out:xml][timeout:200];(area["name"="Norge"]["type"="boundary"];)->.a;(node["place"~"^(%s)$"]["name"][!"ref:ssb_tettsted"](area.a););out meta;' \
+					% "|".join(merge_places)
+		place_root = load_overpass(query, request_header, store=store, offline=args.offline, backend=args.parser).getroot()
 
-	if duplicate:
-		sys.exit ("\n*** Please remove duplicates from OSM before continuing\n")
+		query = ('[out:xml][timeout:200];(area["name"="Norge"]["type"="boundary"];)->.a;(relation["place"="municipality"](area.a););map_to_area->.m;'
+					'foreach.m->.municipality(.municipality out tags;node["place"~"^(%s)$"]["name"][!"ref:ssb_tettsted"](area.municipality);out ids;);') \
+					% "|".join(merge_places)
+		municipality_root = load_overpass(query, request_header, store=store, offline=args.offline, backend=args.parser).getroot()
+
+		place_nodes = {}
+		municipality_places = {}
+		municipality_ref = None
+
+		for element in place_root.iter("node"):
+			place_nodes[ element.attrib['id'] ] = element
+
+		for element in municipality_root:
+			if element.tag == "area":
+				ref_tag = element.find("tag[@k='ref']")
+				if ref_tag != None:
+					municipality_ref = ref_tag.attrib['v']
+					municipality_places[ municipality_ref ] = []
+				else:
+					municipality_ref = None
+			elif element.tag == "node":
+				if municipality_ref and element.attrib['id'] in place_nodes:
+					municipality_places[ municipality_ref ].append(place_nodes[ element.attrib['id'] ])
+
+		place_index = build_place_index(place_nodes.values())
+		name_index = build_name_index(municipality_places)
+		used_places = set()
+
+		message ("%i place nodes\n" % len(place_nodes))
 
 
 	# Load SSB population data
@@ -201,194 +671,248 @@ if __name__ == '__main__':
 #	file = urllib.request.urlopen("https://www.ssb.no/eksport/tabell.csv?key=%s" % ssb_table[ update_year ])
 #	table_string = TextIOWrapper(file, "utf-8").read().replace("\r", "\n").replace("\xa0", "")
 
-	file = open(csv_filename)
-	table_string = file.read()
-
-	ssb_table = csv.DictReader(StringIO(table_string), fieldnames=['settlement','municipality','population_total','population_municipality'], delimiter=";")
-
-	ssb_settlements = {}
-	ssb_count = 0
-	row_count = 0
-
-	for row in ssb_table:
-		row_count += 1
-		if row_count > 2:
+	with profile_phase("load_ssb"):
+		file = open(csv_filename)
+		table_string = file.read()
+
+		ssb_table = csv.DictReader(StringIO(table_string), fieldnames=['settlement','municipality','population_total','population_municipality'], delimiter=";")
+
+		ssb_settlements = {}
+		ssb_count = 0
+		row_count = 0
+
+		for row in ssb_table:
+			row_count += 1
+			if row_count > 2:
+
+				if row['settlement']:
+					ref = row['settlement'][0:4]
+					ssb_count += 1
+					name = row['settlement'][5:].replace(" i alt", "")
+					if "(" in name:
+						name = name[0:name.find("(")].strip()
+					ssb_settlements[ref] = {
+						'name': name,
+						'population': row['population_total'].replace(" ",""),
+						'municipalities': []
+					}
 
-			if row['settlement']:
-				ref = row['settlement'][0:4]
-				ssb_count += 1
-				name = row['settlement'][5:].replace(" i alt", "")
-				if "(" in name:
-					name = name[0:name.find("(")].strip()
-				ssb_settlements[ref] = {
-					'name': name,
-					'population': row['population_total'].replace(" ",""),
-					'municipalities': []
-				}
+					if row['municipality']:
+						municipality = {
+							'ref': row['municipality'][0:4],
+							'name': row['municipality'][5:],
+							'population': row['population_total'].replace(" ", "")
+						}
+						ssb_settlements[ref]['municipalities'].append(municipality)
 
-				if row['municipality']:
+				else:
 					municipality = {
 						'ref': row['municipality'][0:4],
 						'name': row['municipality'][5:],
-						'population': row['population_total'].replace(" ", "")
+						'population': row['population_municipality'].replace(" ", "")
 					}
-					ssb_settlements[ref]['municipalities'].append(municipality)
-
-			else:
-				municipality = {
-					'ref': row['municipality'][0:4],
-					'name': row['municipality'][5:],
-					'population': row['population_municipality'].replace(" ", "")
-				}
-				ssb_settlements[ref]['municipalities'].append(municipality)	
+					ssb_settlements[ref]['municipalities'].append(municipality)	
 
-	file.close()
-	message ("%i urban settlements\n" % ssb_count)
+		file.close()
+		message ("%i urban settlements\n" % ssb_count)
 
 
 	# Split settlements into subareas according to dict
 
 	message ("\nMatch SSB and OSM settlements ...\n")
 
-	for settlement_ref in area_splits:
-		if settlement_ref in ssb_settlements:
+	with profile_phase("match"):
+		for settlement_ref in area_splits:
+			if settlement_ref in ssb_settlements:
 
-			settlement = ssb_settlements[settlement_ref]
-			keep_settlement = False
+				settlement = ssb_settlements[settlement_ref]
+				keep_settlement = False
 
-			for municipality in settlement['municipalities']:
-				if municipality['ref'] in area_splits[ settlement_ref ]:
+				for municipality in settlement['municipalities']:
+					if municipality['ref'] in area_splits[ settlement_ref ]:
 
-					if area_splits[ settlement_ref ][ municipality['ref'] ] == "all":
-						keep_settlement = True
-					else:
-						ref = settlement_ref + "-" + municipality['ref']
-						ssb_settlements[ref] = {
-							'name': municipality['name'],
-							'population': municipality['population'],
-							'municipalities': [ {
-								'ref': municipality['ref'],
+						if area_splits[ settlement_ref ][ municipality['ref'] ] == "all":
+							keep_settlement = True
+						else:
+							ref = settlement_ref + "-" + municipality['ref']
+							ssb_settlements[ref] = {
 								'name': municipality['name'],
-								'population': municipality['population']
-							} ]
-						}
-						ssb_count += 1
-
-			if not keep_settlement:
-				del ssb_settlements[settlement_ref]
-				ssb_count -= 1
+								'population': municipality['population'],
+								'municipalities': [ {
+									'ref': municipality['ref'],
+									'name': municipality['name'],
+									'population': municipality['population']
+								} ]
+							}
+							ssb_count += 1
+
+				if not keep_settlement:
+					del ssb_settlements[settlement_ref]
+					ssb_count -= 1
 
-		else:
-			message ("\tUrban settlement %s in split table not used by SSB\n" % settlement_ref)
+			else:
+				message ("\tUrban settlement %s in split table not used by SSB\n" % settlement_ref)
 
-	for settlement_ref in osm_settlements:
-		if settlement_ref not in ssb_settlements:
-			message ("\tUrban settlement %s in OSM not used by SSB\n" % settlement_ref)
+		for settlement_ref in osm_settlements:
+			if settlement_ref not in ssb_settlements:
+				message ("\tUrban settlement %s in OSM not used by SSB\n" % settlement_ref)
 
 
 	# Produce data
 
 	message ("\nProducing data...\n")
 
-	node_id = -1000
-	update_count = 0
-	new_count = 0
-	notfound_count = 0
-
-	for settlement_ref, settlement in iter(ssb_settlements.items()):
-		if settlement_ref in osm_settlements:
-			# Update settlement tags
+	with profile_phase("geocode"):
+		node_id = -1000
+		update_count = 0
+		new_count = 0
+		merge_count = 0
+		name_count = 0
+		notfound_count = 0
 
-			element = osm_settlements[settlement_ref]
-			update1 = update_tag (element, "population", settlement['population'])
-			update2 = update_tag (element, "population:date", update_date)
-			update3 = update_tag (element, "source:population", source)
+		for settlement_ref, settlement in iter(ssb_settlements.items()):
+			if settlement_ref in osm_settlements:
+				# Update settlement tags
 
-			if update1 or update2 or update3:
-				update_count += 1
+				element = osm_settlements[settlement_ref]
+				update1 = update_tag (element, "population", settlement['population'])
+				update2 = update_tag (element, "population:date", update_date)
+				update3 = update_tag (element, "source:population", source)
 
-		else:
-			# Geocode new settlement
+				if update1 or update2 or update3:
+					update_count += 1
 
-			result = None
-			only_municipality = False
-		
-			if "/" in settlement['name']:
-				names = settlement['name'].split("/")
 			else:
-				names = settlement['name'].split("-")
-
-			for municipality in settlement['municipalities']:
-				for settlement_name in names:
-					result = ssr_search(settlement_name, municipality['ref'])
-					if result != None:
-						municipality_name = municipality['name']
-						break
+				# Geocode new settlement, or reuse result from journal
+
+				if "/" in settlement['name']:
+					names = settlement['name'].split("/")
+				else:
+					names = settlement['name'].split("-")
+
+				# Update existing place node in municipality with matching name, instead of geocoding
+				# Place nodes with another name than the full settlement name are tagged for verification
+
+				candidate = find_name_match(name_index, settlement, [settlement['name']] + names)
+				if candidate != None:
+					node, score = candidate
+					message ("\t%s [%s] -> place=%s '%s' (name match %i%%)\n" % (settlement['name'], settlement['population'],
+								node.find("tag[@k='place']").attrib['v'], node.find("tag[@k='name']").attrib['v'], score * 100))
+
+					update_place (node, settlement_ref, settlement)
+					if normalize_name(node.find("tag[@k='name']").attrib['v']) != normalize_name(settlement['name']):
+						node.append(ET.Element("tag", k="MERGE", v="%s (name %i%%)" % (settlement['name'], score * 100)))
+					osm_root.append(node)
+
+					name_count += 1
+					continue
+
+				if settlement_ref in journal:
+					result, municipality_name, only_municipality = journal[ settlement_ref ]
+				else:
+					result, municipality_name, only_municipality = geocode_settlement(settlement, names)
+					journal_file.write(json.dumps({
+						'ref': settlement_ref,
+						'result': result,
+						'municipality': municipality_name,
+						'only_municipality': only_municipality
+					}) + "\n")
+					journal_file.flush()
+
+				# Update existing place node nearby with similar name instead of creating a new node
+
+				if result != None and not only_municipality:
+					candidate = find_merge_candidate(place_index, float(result[0]), float(result[1]), [settlement['name']] + names)
+					if candidate != None:
+						node, node_distance = candidate
+						message ("\t%s [%s] -> merge with place=%s '%s' (%i m)\n" % (settlement['name'], settlement['population'],
+									node.find("tag[@k='place']").attrib['v'], node.find("tag[@k='name']").attrib['v'], node_distance))
+
+						update_place (node, settlement_ref, settlement)
+						node.append(ET.Element("tag", k="MERGE", v="%s (%i m)" % (settlement['name'], node_distance)))
+						osm_root.append(node)
+
+						merge_count += 1
+						continue
+
 				if result != None:
-					break
+					latitude = str(result[0])
+					longitude = str(result[1])
+					result_type = result[2]
+					message ("\t%s [%s] -> %s, %s" % (settlement['name'], settlement['population'], result_type, municipality_name))
+					if only_municipality:
+						message (" -> *** LOCATION NOT FOUND")
+						notfound_count += 1
+					message ("\n")
+				else:
+					message ("\t%s [%s] -> *** LOCATION NOT FOUND\n" % (settlement['name'], settlement['population']))
+					latitude = "0"
+					longitude = "0"
+					result_type = ""
+					municipality_name = ""
+					notfound_count += 1
 
-			if result == None:
-				for municipality in settlement['municipalities']:
-					result = ssr_search(municipality['name'] + "*", municipality['ref'])
-					if result != None:
-						municipality_name = municipality['name']
-						only_municipality = True
-						break		
+				# Create new settlement node
 
-			if result != None:
-				latitude = str(result[0])
-				longitude = str(result[1])
-				result_type = result[2]
-				message ("\t%s [%s] -> %s, %s" % (settlement['name'], settlement['population'], result_type, municipality_name))
-				if only_municipality:
-					message (" -> *** LOCATION NOT FOUND")
-					notfound_count += 1
-				message ("\n")
-			else:
-				message ("\t%s [%s] -> *** LOCATION NOT FOUND\n" % (settlement['name'], settlement['population']))
-				latitude = "0"
-				longitude = "0"
-				result_type = ""
-				municipality_name = ""
-				notfound_count += 1
-
-			# Create new settlement node
-
-			node_id -= 1
-			node = ET.Element("node", id=str(node_id), action="modify", lat=latitude, lon=longitude)
-			osm_root.append(node)
-			node.append(ET.Element("tag", k="name", v=settlement['name']))
-			node.append(ET.Element("tag", k="ref:ssb_tettsted", v=settlement_ref))
-			node.append(ET.Element("tag", k="population", v=settlement['population']))
-			node.append(ET.Element("tag", k="population:date", v=update_date))
-			node.append(ET.Element("tag", k="source:population", v=source))
-			node.append(ET.Element("tag", k="MUNICIPALITY", v=municipality_name))
-
-			if len(settlement['municipalities']) > 1:
-				sub_populations = []
-				for municipality in settlement['municipalities']:
-					sub_populations.append("%s (%s)" % (municipality['name'], municipality['population']))
-				node.append(ET.Element("tag", k="SUBAREAS", v=";".join(sub_populations)))
+				node_id -= 1
+				node = ET.Element("node", id=str(node_id), action="modify", lat=latitude, lon=longitude)
+				osm_root.append(node)
+				node.append(ET.Element("tag", k="name", v=settlement['name']))
+				node.append(ET.Element("tag", k="ref:ssb_tettsted", v=settlement_ref))
+				node.append(ET.Element("tag", k="population", v=settlement['population']))
+				node.append(ET.Element("tag", k="population:date", v=update_date))
+				node.append(ET.Element("tag", k="source:population", v=source))
+				node.append(ET.Element("tag", k="MUNICIPALITY", v=municipality_name))
 
-			if result_type:
-				node.append(ET.Element("tag", k="SSR", v=result_type))
+				if len(settlement['municipalities']) > 1:
+					sub_populations = []
+					for municipality in settlement['municipalities']:
+						sub_populations.append("%s (%s)" % (municipality['name'], municipality['population']))
+					node.append(ET.Element("tag", k="SUBAREAS", v=";".join(sub_populations)))
 
-			if only_municipality:
-				node.append(ET.Element("tag", k="NOT_FOUND", v="yes"))
+				if result_type:
+					node.append(ET.Element("tag", k="SSR", v=result_type))
+
+				if only_municipality:
+					node.append(ET.Element("tag", k="NOT_FOUND", v="yes"))
+
+				new_count += 1
 
-			new_count += 1
 
 
 	# Produce OSM/XML file
+	# Journal is no longer needed when file is saved
 
-	filename = "tettsted_%s.osm" % update_year
-	osm_root.set("generator", "population2osm v%s" % version)
-	osm_root.set("upload", "false")
-	osm_tree.write(filename, encoding="utf-8", method="xml", xml_declaration=True)
+	with profile_phase("write"):
+		filename = "tettsted_%s.osm" % update_year
+		if args.split:
+			filenames = split_osm(osm_tree, filename, "population2osm v%s" % version, args.split, settlement_county)
+			filename = "', '".join(filenames)
+		else:
+			save_osm(osm_tree, filename, "population2osm v%s" % version)
+
+	journal_file.close()
+	os.remove(journal_filename)
 
 	message ("\nSaving ... %i urban settlements saved in file '%s'\n" % (ssb_count, filename))
-	message ("\tAlready correct: %i\n" % (ssb_count - update_count - new_count))
+	message ("\tAlready correct: %i\n" % (ssb_count - update_count - new_count - merge_count - name_count))
 	message ("\tUpdated:         %i\n" % update_count)
 	message ("\tNew:             %i\n" % new_count)
-	message ("\tNot used:        %i\n" % (osm_count - ssb_count + new_count))
+	message ("\tName match:      %i\n" % name_count)
+	message ("\tMerge with OSM:  %i\n" % merge_count)
+	message ("\tNot used:        %i\n" % (osm_count - ssb_count + new_count + merge_count + name_count))
 	message ("\tCheck location:  %i\n\n" % notfound_count)
+
+	# Upload to OSM
+
+	if args.upload:
+		message ("Uploading to %s ...\n" % args.api)
+		with profile_phase("upload"):
+			changeset_tags = {
+				'created_by': "population2osm v%s" % version,
+				'comment': "Update population of urban settlements",
+				'source': "SSB - befolkning i tettstedet",
+				'population:date': update_date
+			}
+			changeset_id, uploaded, skipped = upload_osm(osm_tree, args.api, os.environ['OSM_ACCESS_TOKEN'], request_header, changeset_tags, args.upload)
+		message ("Uploaded %i elements in changeset %s, %i elements with working tags not uploaded\n\n" % (uploaded, changeset_id, skipped))